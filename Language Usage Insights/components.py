@@ -1,8 +1,14 @@
 from altair.utils.schemapi import Undefined
-from snowflake.snowpark import Session
-from typing import Tuple
+from snowflake.snowpark import DataFrame, Session, Table
+from typing import Dict, List, Tuple
 from utils import get_column_config
-from utils import gradient_color_array, select_country_data
+from utils import (
+    gradient_color_array,
+    select_country_data,
+    select_daily_totals,
+    select_locale_data,
+    select_rolling_data,
+)
 import altair as alt
 import json
 import pandas as pd
@@ -10,6 +16,9 @@ import pydeck as pdk
 import sqlparse
 import streamlit as st
 
+# How long the daily totals and the locale series are cached, so new usage data shows up.
+DATA_TTL_SECONDS = 60 * 60
+
 
 def data_chart_container(
     dataframe: pd.DataFrame,
@@ -55,34 +64,68 @@ def data_chart_container(
     )
 
 
+@st.cache_resource(show_spinner=False, ttl=DATA_TTL_SECONDS)
+def get_daily_totals_table(_session: Session) -> Table:
+    """
+    Materialize the daily totals of all locales, so normalizing doesn't aggregate the whole usage table on every rerun.
+    They are materialized again once expired, and the temporary table of the expired totals is dropped with the session.
+    """
+    return _session.sql(select_daily_totals()).cache_result()
+
+
 def group_and_agreaggate_data(
-    session: Session, data: pd.DataFrame, normalize: bool, rolling: int
-) -> pd.DataFrame:
+    session: Session,
+    source_query: str,
+    params: List[str],
+    normalize: bool,
+    rolling: int,
+) -> DataFrame:
     """
     Group data by locale, to get the mean in a given period of time, this is based on the rolling parameter. Could be 1 (Daily), 7 (Weekly), 28 (Monthly).
-    If normalize is enable, the original data is joined with other query that get absolute values, in order to get percentages values.
-    """
-    if normalize:
-        totals = session.sql(
-            "SELECT DATE, SUM(NUM_DEVELOPERS) AS NUM_DEVELOPERS_TOTAL FROM LOCALE_USAGE GROUP BY DATE ORDER BY DATE;"
-        ).to_pandas()
-
-        data = data.merge(totals, on="DATE", suffixes=(None, "_TOTAL"))
-        data["NUM_DEVELOPERS"] = data["NUM_DEVELOPERS"].astype(float) / data[
-            "NUM_DEVELOPERS_TOTAL"
-        ].astype(float)
-
-    data = data.sort_values(["LOCALE", "DATE"])
-    data["NUM_DEVELOPERS"] = (
-        data.groupby("LOCALE")["NUM_DEVELOPERS"]
-        .rolling(window=rolling)
-        .mean()
-        .reset_index(level=0, drop=True)
+    If normalize is enable, the original data is joined with the daily totals table, in order to get percentages values.
+    Both steps run in Snowflake with window functions, so only the final series are returned.
+    """
+    return session.sql(
+        get_rolling_query(session, source_query, normalize, rolling), params=params
     )
 
-    data = data.dropna(subset=["NUM_DEVELOPERS"])
 
-    return data
+def get_rolling_query(
+    session: Session, source_query: str, normalize: bool, rolling: int
+) -> str:
+    """
+    Get the query that aggregates the source query, joined with the daily totals table if normalize is enable.
+    """
+    totals_table = get_daily_totals_table(session).table_name if normalize else None
+
+    return select_rolling_data(source_query, rolling, totals_table)
+
+
+@st.cache_data(show_spinner=False, ttl=DATA_TTL_SECONDS)
+def get_locale_series(
+    _session: Session, locale: str, normalize: bool, rolling: int
+) -> pd.DataFrame:
+    """
+    Get the aggregated series of a single locale. Every locale is cached on its own, so only newly selected locales are queried.
+    """
+    return group_and_agreaggate_data(
+        _session, select_locale_data([locale]), [locale], normalize, rolling
+    ).to_pandas()
+
+
+def get_locales_series(
+    session: Session, locale_list: List[str], normalize: bool, rolling: int
+) -> pd.DataFrame:
+    """
+    Concatenate the cached series of every selected locale.
+    """
+    return pd.concat(
+        [
+            get_locale_series(session, locale, normalize, rolling)
+            for locale in locale_list
+        ],
+        ignore_index=True,
+    )
 
 
 def locale_line_chart(
@@ -116,13 +159,29 @@ def locale_line_chart(
     )
 
 
+@st.cache_data(show_spinner=False)
+def get_country_geometries(_session: Session) -> Dict[str, dict]:
+    """
+    Build an index of parsed country geometries, keyed by the lowercase country name.
+    """
+    country_data = _session.sql(select_country_data()).to_pandas()
+
+    return {
+        country.lower(): {
+            "name": country,
+            "geometry": json.loads(geometry.replace("'", '"')),
+        }
+        for country, geometry in zip(country_data["COUNTRY"], country_data["GEOMETRY"])
+    }
+
+
 def polygon_heatmap_chart(
     session: Session, data: pd.DataFrame, normalize: bool
 ) -> None:
     """
-    Arranged language data in order to create pydeck GeoJson layers, that are rendered in a pydeck heatmap chart.
+    Arranged language data in order to create a pydeck GeoJson layer, that is rendered in a pydeck heatmap chart.
     """
-    country_data = session.sql(select_country_data()).to_pandas()
+    country_geometries = get_country_geometries(session)
 
     data = (
         data.sort_values(by=["NUM_DEVELOPERS"], ascending=[False])
@@ -134,28 +193,34 @@ def polygon_heatmap_chart(
 
     color_array = gradient_color_array(len(data))
 
-    layer_arr = []
-    for index, row in data.iterrows():
-        found_country = country_data[
-            country_data["COUNTRY"].str.lower() == row["COUNTRY"].lower()
-        ]
+    features = []
+    for country, num_dev, color in zip(
+        data["COUNTRY"], data["NUM_DEVELOPERS"], color_array
+    ):
+        found_country = country_geometries.get(country.lower())
 
-        if len(found_country) != 0:
-            polygon_layer = pdk.Layer(
-                "GeoJsonLayer",
-                data={
+        if found_country is not None:
+            features.append(
+                {
                     "type": "Feature",
-                    "name": found_country.iloc[0, 0],
-                    "geometry": json.loads(found_country.iloc[0, 1].replace("'", '"')),
-                    "num_dev": int(row.iloc[2]),
-                },
-                filled=True,
-                get_fill_color=color_array[index],
-                stroked=True,
-                pickable=True,
-                opacity=0.5,
+                    "geometry": found_country["geometry"],
+                    "properties": {
+                        "name": found_country["name"],
+                        "num_dev": int(num_dev),
+                        "color": color,
+                    },
+                }
             )
-            layer_arr.append(polygon_layer)
+
+    polygon_layer = pdk.Layer(
+        "GeoJsonLayer",
+        data={"type": "FeatureCollection", "features": features},
+        filled=True,
+        get_fill_color="properties.color",
+        stroked=True,
+        pickable=True,
+        opacity=0.5,
+    )
 
     tooltip = {
         "html": "<b>Name:</b> {name}"
@@ -163,7 +228,7 @@ def polygon_heatmap_chart(
     }
 
     # Create a Pydeck Deck with the polygon layer
-    deck = pdk.Deck(map_style=None, layers=layer_arr, tooltip=tooltip)
+    deck = pdk.Deck(map_style=None, layers=[polygon_layer], tooltip=tooltip)
 
     # Render the Pydeck chart using Streamlit
     st.pydeck_chart(deck)
@@ -3,11 +3,13 @@ from components import (
     locale_line_chart,
     polygon_heatmap_chart,
     group_and_agreaggate_data,
+    get_locales_series,
+    get_rolling_query,
 )
 from locale_list import LOCALE_OPTIONS
 from snowflake.snowpark import Session
 from snowflake.snowpark.context import get_active_session
-from utils import select_union_data, select_locale_data
+from utils import bind_query_params, select_union_data, select_locale_data
 import streamlit as st
 
 st.set_page_config(layout="wide")
@@ -76,19 +78,31 @@ if selection == []:
     st.warning("You must choose a language first.")
 else:
     if union:
-        dataframe = session.sql(select_union_data(selection))
+        agreggated_data = group_and_agreaggate_data(
+            session, select_union_data(selection), selection, normalize, rolling
+        ).to_pandas()
+        sql_query = bind_query_params(
+            get_rolling_query(session, select_union_data(selection), normalize, rolling),
+            selection,
+        )
     else:
-        dataframe = session.sql(select_locale_data(selection))
+        agreggated_data = get_locales_series(session, selection, normalize, rolling)
+        # Every locale is fetched with its own query, so all of them are listed.
+        sql_query = "\n".join(
+            f"-- {locale}\n"
+            + bind_query_params(
+                get_rolling_query(
+                    session, select_locale_data([locale]), normalize, rolling
+                ),
+                [locale],
+            )
+            + ";"
+            for locale in selection
+        )
 
     # Bar chart
     description = "We count the number of daily active views that use a given language."
 
-    sql_query = str(dataframe._plan.queries[0].sql)
-
-    agreggated_data = group_and_agreaggate_data(
-        session, dataframe.to_pandas(), normalize, rolling
-    )
-
     line_chart = locale_line_chart(agreggated_data, normalize, union)
 
     data_chart_container(
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 import numpy as np
 import pandas as pd
 import streamlit as st
@@ -7,6 +7,7 @@ import streamlit as st
 def select_locale_data(locale_list: List[str]) -> str:
     """
     Select all from `LOCALE_USAGE` where the `LOCALE` is in the parameter list.
+    The locales are bound parameters, so they have to be passed along with the query.
     """
     return f"""
             SELECT
@@ -18,17 +19,15 @@ def select_locale_data(locale_list: List[str]) -> str:
                    LOCALE_USAGE
             WHERE
                    LOCALE IN (
-                          {str(locale_list).replace('[', '').replace(']', '')}
+                          {', '.join('?' for _ in locale_list)}
                    )
-            ORDER BY
-                LOCALE,
-                DATE;
             """
 
 
 def select_union_data(locale_list: List[str]) -> str:
     """
     Select date and the sum of all the developers that are in that date, filtered by the locale list.
+    The locales are bound parameters, so they have to be passed along with the query.
     """
     return f"""
             SELECT
@@ -39,13 +38,74 @@ def select_union_data(locale_list: List[str]) -> str:
                    LOCALE_USAGE
             WHERE
                    LOCALE IN (
-                          {str(locale_list).replace('[', '').replace(']', '')}
+                          {', '.join('?' for _ in locale_list)}
                    )
             GROUP BY
-                DATE;
+                DATE
             """
 
 
+def select_daily_totals() -> str:
+    """
+    Select the sum of all the developers for every date, regardless of the locale.
+    """
+    return """
+            SELECT
+                   DATE,
+                   SUM(NUM_DEVELOPERS) AS NUM_DEVELOPERS_TOTAL
+            FROM
+                   LOCALE_USAGE
+            GROUP BY
+                DATE
+            """
+
+
+def select_rolling_data(
+    source_query: str, rolling: int, totals_table: Optional[str] = None
+) -> str:
+    """
+    Select the rolling mean of the developers per locale over the given number of days from the source query.
+    If a totals table is given, the developers are divided by the daily totals first in order to get percentages values.
+    """
+    value = (
+        "DATA.NUM_DEVELOPERS::FLOAT / TOTALS.NUM_DEVELOPERS_TOTAL"
+        if totals_table
+        else "DATA.NUM_DEVELOPERS"
+    )
+    join = (
+        f"INNER JOIN {totals_table} AS TOTALS ON DATA.DATE = TOTALS.DATE"
+        if totals_table
+        else ""
+    )
+    return f"""
+            SELECT
+                   DATA.* EXCLUDE NUM_DEVELOPERS,
+                   AVG({value}) OVER (
+                          PARTITION BY DATA.LOCALE
+                          ORDER BY DATA.DATE
+                          ROWS BETWEEN {rolling - 1} PRECEDING AND CURRENT ROW
+                   ) AS NUM_DEVELOPERS
+            FROM
+                   ({source_query}) AS DATA
+            {join}
+            QUALIFY
+                ROW_NUMBER() OVER (PARTITION BY DATA.LOCALE ORDER BY DATA.DATE) >= {rolling}
+            ORDER BY
+                DATA.LOCALE,
+                DATA.DATE
+            """
+
+
+def bind_query_params(query: str, params: List[str]) -> str:
+    """
+    Replace the bound parameters of a query by their quoted values, to display the query as it is run.
+    """
+    for param in params:
+        quoted_param = "'" + param.replace("'", "''") + "'"
+        query = query.replace("?", quoted_param, 1)
+    return query
+
+
 def select_country_data() -> str:
     """
     Select geometry information of some countries around the world.
@@ -84,15 +144,8 @@ def gradient_color_array(array_length: int) -> List[List[int]]:
     if array_length == 1:
         return [tuple(int(x) for x in end_color)]
 
-    values = np.arange(array_length)
-    # Normalize values to range [0, 1]
-    normalized_values = (values - np.min(values)) / (np.max(values) - np.min(values))
-
-    # Interpolate RGB values based on normalized values
-    interpolated_colors = []
-    for value in normalized_values:
-        interpolated_color = (1 - value) * start_color + value * end_color
-        rgb_tuple = tuple(int(x) for x in interpolated_color)
-        interpolated_colors.append(rgb_tuple)
+    # Normalize positions to range [0, 1] and interpolate all RGB values at once
+    normalized_values = np.linspace(0, 1, array_length)[:, np.newaxis]
+    interpolated_colors = (1 - normalized_values) * start_color + normalized_values * end_color
 
-    return interpolated_colors
+    return [tuple(int(x) for x in color) for color in interpolated_colors.astype(int)]
@@ -23,9 +23,22 @@ st.write(
     - [U.S. ZIP Code Metadata with Geometry](https://app.snowflake.com/marketplace/listing/GZTYZ7P39MI/sfr-analytics-u-s-zip-code-metadata-with-geometry)
     """)
 session = get_active_session()
-df = session.sql('select geom as border from CARTO_Academy__Data_for_tutorials.CARTO.CELL_TOWERS_NY').to_pandas()
-df["lon"] = df["BORDER"].apply(lambda row: json.loads(row)["coordinates"][0])
-df["lat"] = df["BORDER"].apply(lambda row: json.loads(row)["coordinates"][1])
+
+
+@st.cache_data(show_spinner=False)
+def get_tower_points() -> pd.DataFrame:
+    # Coordinates are extracted in Snowflake and fetched as Arrow batches,
+    # so no GeoJSON has to be parsed on the Python side.
+    batches = session.sql('select st_x(geom) as lon, st_y(geom) as lat\n'\
+                          'from CARTO_Academy__Data_for_tutorials.CARTO.CELL_TOWERS_NY').to_pandas_batches()
+    batches = list(batches)
+    if not batches:
+        return pd.DataFrame({"lon": pd.Series(dtype=float), "lat": pd.Series(dtype=float)})
+    df = pd.concat(batches, ignore_index=True)
+    return df.rename(columns=str.lower)
+
+
+df = get_tower_points()
 
 st.pydeck_chart(pdk.Deck(
     map_style=None,
@@ -135,22 +148,45 @@ def get_color(df_column: pd.Series, colors: List, vmin: int, vmax: int, index: p
     return df_column.apply(color_map.rgb_bytes_tuple)
     
 st.title("Cell Towers density per zip code")
-df_4 = session.sql('''select zip_code, any_value(st_asgeojson(geometry)) as geom, count(*) as count
+
+
+ZIP_TOWER_COUNTS_QUERY = '''select zip_code, count(*) as count
                         from U_S__ZIP_CODE_METADATA_WITH_GEOMETRY.PUBLIC.ZIP_CODE_GEOMETRY_SHARE t1
                         inner join CARTO_Academy__Data_for_tutorials.CARTO.CELL_TOWERS_NY t2
                         on st_within(t2.geom, to_geography(st_setsrid(t1.geometry, 4326)))
-                        group by all;''').to_pandas()
+                        group by all'''
+
+
+@st.cache_data(show_spinner=False)
+def get_zip_tower_counts() -> pd.DataFrame:
+    return session.sql(ZIP_TOWER_COUNTS_QUERY).to_pandas()
 
-df_4["coordinates"] = df_4["GEOM"].apply(lambda row: json.loads(row)["coordinates"][0])
 
+def get_simplify_tolerance(zoom: int, latitude: float) -> int:
+    # Roughly the ground size of one screen pixel (in meters) at this zoom level
+    return max(1, int(156543.03 * np.cos(np.radians(latitude)) / 2 ** zoom))
 
-gc = {
-    "type" : "GeometryCollection",
-    "geometries" : [json.loads(poly) for poly in df_4.GEOM]
-}
 
+@st.cache_data(show_spinner=False)
+def get_zip_polygons(tolerance: int) -> pd.DataFrame:
+    counts = get_zip_tower_counts()
+    # Only the zip codes with towers are simplified, filtered in Snowflake by the same join as the counts
+    geoms = session.sql(f'''select zip_code,
+                            st_asgeojson(st_simplify(to_geography(st_setsrid(geometry, 4326)), ?, TRUE)) as geom
+                            from U_S__ZIP_CODE_METADATA_WITH_GEOMETRY.PUBLIC.ZIP_CODE_GEOMETRY_SHARE
+                            where zip_code in (select zip_code from ({ZIP_TOWER_COUNTS_QUERY}))''',
+                        params=[tolerance]).to_pandas()
+    geoms = geoms.drop_duplicates("ZIP_CODE")
+    geoms["GEOM"] = geoms["GEOM"].apply(json.loads)
+    # Keep out anything the simplification turned into something other than a polygon
+    geoms = geoms[geoms["GEOM"].map(lambda geom: geom["type"]).isin(["Polygon", "MultiPolygon"])].copy()
+    geoms["coordinates"] = [geom["coordinates"][0] for geom in geoms["GEOM"]]
+    return counts.merge(geoms[["ZIP_CODE", "coordinates"]], on="ZIP_CODE")
 
 
+zoom_4 = st.slider("Map zoom", min_value=8, max_value=14, value=11)
+df_4 = get_zip_polygons(get_simplify_tolerance(zoom_4, 40.782585))
+
 quantiles_4 = get_quantiles(df_4["COUNT"], [0, 0.33, 0.66, 1])
 colors_4 = ['gray','blue','green','yellow','orange','red']
 
@@ -177,7 +213,7 @@ st.pydeck_chart(pdk.Deck(
     map_style=None,
     initial_view_state=pdk.ViewState(
         latitude=40.782585,
-        longitude=-73.994529, pitch=45, zoom=11),
+        longitude=-73.994529, pitch=45, zoom=zoom_4),
     tooltip={
             'html': '<b>Zip Code:</b> {ZIP_CODE}<br><b>Cell Towers:</b> {COUNT}',
              'style': {
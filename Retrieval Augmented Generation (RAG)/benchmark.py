@@ -0,0 +1,361 @@
+"""
+Offline benchmark of the retrieval of the RAG app.
+
+Runs a labelled question set against `ChunkIndex` and the context packer, with a local stand-in
+for the Cortex embedding and an in-memory chunk table, so it needs no Snowflake connection.
+A retrieved chunk is relevant when it comes from the labelled file and contains the labelled answer.
+
+    python benchmark.py --num-chunks 10 --k 1 3 5 --model mixtral-8x7b
+
+With `--calibrate-answer-cache` it instead measures, for a range of similarity thresholds of `AnswerCache`,
+how many reworded questions get the cached answer and how many questions get the answer of another question.
+"""
+
+from pathlib import Path
+from retrieval import (
+    ANSWER_TOKENS,
+    MAX_CONTEXT_SIMILARITY_DROP,
+    MIN_CONTEXT_SIMILARITY,
+    PROMPT_TEMPLATE_TOKENS,
+    ChunkIndex,
+    estimate_tokens,
+    get_content_words,
+    get_context_budget,
+    normalize,
+    normalize_text,
+    pack_context,
+    word_jaccard,
+)
+from typing import Callable, Dict, List, Tuple
+import argparse
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+import re
+import time
+
+APP_FOLDER = Path(__file__).parent
+WORD_RE = re.compile(r"\w+")
+
+# Same chunk size and overlap as `PDF_TEXT_CHUNKER` in `data/creation_script.sql`.
+CHUNK_SIZE = 4000
+CHUNK_OVERLAP = 400
+
+
+def hash_embedding(text: str, dimension: int = 768) -> np.ndarray:
+    """
+    Stand-in for EMBED_TEXT_768: a signed feature hashing of the words and word bigrams of the text.
+    """
+    words = WORD_RE.findall(normalize_text(text))
+    features = words + [" ".join(bigram) for bigram in zip(words, words[1:])]
+    vector = np.zeros(dimension, dtype=np.float32)
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], "little")
+        vector[index % dimension] += 1.0 if digest[4] & 1 else -1.0
+
+    return np.sign(vector) * np.log1p(np.abs(vector))
+
+
+def split_text(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """
+    Split a text in chunks of at most `chunk_size` characters on word boundaries,
+    each one repeating about `chunk_overlap` characters of the previous one.
+    """
+    words = text.split()
+    chunks = []
+    start = 0
+    while start < len(words):
+        end, length = start, 0
+        while end < len(words) and length + len(words[end]) <= chunk_size:
+            length += len(words[end]) + 1
+            end += 1
+        end = max(end, start + 1)
+        chunks.append(" ".join(words[start:end]))
+        if end == len(words):
+            break
+
+        overlap_start, overlap = end, 0
+        while overlap_start > start + 1 and overlap < chunk_overlap:
+            overlap_start -= 1
+            overlap += len(words[overlap_start]) + 1
+        start = overlap_start
+
+    return chunks
+
+
+def load_pdf_chunks(docs_folder: Path) -> pd.DataFrame:
+    """
+    Build a chunk table from the PDFs of the docs folder, with the chunk size and overlap of `DOCS_CHUNKS_TABLE`.
+    The text extraction and splitting differ from the UDF, which uses PyPDF2 and langchain, so the chunk boundaries
+    don't match production; benchmark a CSV export of the table with `--chunks` for that.
+    """
+    import pypdfium2 as pdfium
+
+    rows = []
+    for path in sorted(docs_folder.glob("*.pdf")):
+        pdf = pdfium.PdfDocument(path)
+        text = " ".join(
+            pdf[page_number].get_textpage().get_text_range()
+            for page_number in range(len(pdf))
+        )
+        for chunk in split_text(text, CHUNK_SIZE, CHUNK_OVERLAP):
+            rows.append({"RELATIVE_PATH": path.name, "CHUNK": chunk})
+
+    return pd.DataFrame(rows)
+
+
+def build_index(chunks: pd.DataFrame) -> ChunkIndex:
+    """
+    Index the chunk table with the stand-in embedding.
+    """
+    chunk_index = ChunkIndex()
+    chunk_index.add(
+        chunks.index.astype(str),
+        chunks["RELATIVE_PATH"],
+        chunks["CHUNK"],
+        np.array([hash_embedding(chunk) for chunk in chunks["CHUNK"]]),
+    )
+    return chunk_index
+
+
+def is_relevant(chunk: str, relative_path: str, question: pd.Series) -> bool:
+    return relative_path == question["RELATIVE_PATH"] and normalize_text(
+        question["ANSWER"]
+    ) in normalize_text(chunk)
+
+
+def run_benchmark(
+    chunks: pd.DataFrame,
+    questions: pd.DataFrame,
+    num_chunks: int,
+    ks: List[int],
+    model: str,
+    repeat: int,
+    min_similarity: float,
+    max_similarity_drop: float,
+) -> pd.Series:
+    """
+    Run every question against the index and aggregate the retrieval metrics.
+    """
+    chunk_index = build_index(chunks)
+    latencies = []
+    ranks = []
+    prompt_tokens = []
+    packed_chunks = []
+    context_hits = []
+
+    for _, question in questions.iterrows():
+        query_vector = hash_embedding(question["QUESTION"])
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results = chunk_index.search(query_vector, num_chunks)
+            latencies.append(time.perf_counter() - start)
+
+        relevant = [
+            is_relevant(chunk, relative_path, question)
+            for chunk, relative_path in zip(results["CHUNK"], results["RELATIVE_PATH"])
+        ]
+        ranks.append(relevant.index(True) + 1 if True in relevant else None)
+
+        # Same budget as `get_cortex_prompt`, for a question without chat history
+        question_tokens = estimate_tokens(question["QUESTION"])
+        reserved_tokens = question_tokens + PROMPT_TEMPLATE_TOKENS + ANSWER_TOKENS
+        context = pack_context(
+            results,
+            get_context_budget(model, reserved_tokens),
+            min_similarity,
+            max_similarity_drop,
+        )
+        context_tokens = sum(estimate_tokens(chunk) for chunk in context["CHUNK"])
+        prompt_tokens.append(context_tokens + question_tokens + PROMPT_TEMPLATE_TOKENS)
+        packed_chunks.append(len(context))
+        context_hits.append(
+            any(
+                is_relevant(chunk, relative_path, question)
+                for chunk, relative_path in zip(context["CHUNK"], context["RELATIVE_PATH"])
+            )
+        )
+
+    metrics = {
+        f"recall@{k}": np.mean([rank is not None and rank <= k for rank in ranks])
+        for k in ks
+    }
+    metrics["mrr"] = np.mean([1 / rank if rank else 0.0 for rank in ranks])
+    metrics["context_recall"] = np.mean(context_hits)
+    metrics["p50_latency_ms"] = np.percentile(latencies, 50) * 1000
+    metrics["p95_latency_ms"] = np.percentile(latencies, 95) * 1000
+    metrics["mean_prompt_tokens"] = np.mean(prompt_tokens)
+    metrics["max_prompt_tokens"] = np.max(prompt_tokens)
+    metrics["mean_context_chunks"] = np.mean(packed_chunks)
+
+    return pd.Series(metrics)
+
+
+def load_embeddings(path: Path) -> Callable[[str], np.ndarray]:
+    """
+    Load embeddings exported from Snowflake, with a TEXT column and an EMBEDDING column holding
+    `SNOWFLAKE.CORTEX.EMBED_TEXT_768` of the lowercase text as a JSON array.
+    """
+    embeddings = pd.read_csv(path)
+    vectors: Dict[str, np.ndarray] = {
+        normalize_text(text): np.array(json.loads(embedding), dtype=np.float32)
+        for text, embedding in zip(embeddings["TEXT"], embeddings["EMBEDDING"])
+    }
+
+    def embed(text: str) -> np.ndarray:
+        return vectors[normalize_text(text)]
+
+    return embed
+
+
+def get_question_pairs(
+    questions: pd.DataFrame, embed: Callable[[str], np.ndarray]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Similarity and content word overlap of every question and paraphrase with every question,
+    and whether the pair is a question and its own paraphrase (or itself).
+    """
+    texts = list(questions["QUESTION"]) + list(questions["PARAPHRASE"])
+    vectors = normalize(
+        np.array([np.asarray(embed(text), dtype=np.float32) for text in texts])
+    )
+    words = [get_content_words(text) for text in texts]
+    similarities = vectors @ vectors[: len(questions)].T
+    overlaps = np.array(
+        [
+            [word_jaccard(text_words, question_words) for question_words in words[: len(questions)]]
+            for text_words in words
+        ]
+    )
+    same_question = np.tile(np.eye(len(questions), dtype=bool), (2, 1))
+    return similarities, overlaps, same_question
+
+
+def calibrate_answer_cache(
+    questions: pd.DataFrame,
+    embed: Callable[[str], np.ndarray],
+    thresholds: List[float],
+    min_word_overlap: float,
+) -> Tuple[pd.DataFrame, pd.Series]:
+    """
+    For each threshold, the share of paraphrases that get the answer of their question (hits), and the share
+    of questions and paraphrases that would get the answer of another question (wrong hits), with and without
+    the word overlap guard of `AnswerCache`. Also how far apart paraphrases and other questions are.
+    """
+    similarities, overlaps, same_question = get_question_pairs(questions, embed)
+    paraphrases = np.arange(len(similarities)) >= len(questions)
+    own_pairs = same_question & paraphrases[:, np.newaxis]
+
+    rows = []
+    for threshold in thresholds:
+        for guarded in (False, True):
+            matches = similarities >= threshold
+            if guarded:
+                matches &= overlaps >= min_word_overlap
+            rows.append(
+                {
+                    "threshold": threshold,
+                    "word_overlap_guard": guarded,
+                    "paraphrase_hits": matches[own_pairs].mean(),
+                    "wrong_hits": (matches & ~same_question).any(axis=1).mean(),
+                }
+            )
+
+    separation = pd.Series(
+        {
+            "min_paraphrase_similarity": similarities[own_pairs].min(),
+            "max_other_question_similarity": similarities[~same_question].max(),
+            "min_paraphrase_word_overlap": overlaps[own_pairs].min(),
+            "max_other_question_word_overlap": overlaps[~same_question].max(),
+        }
+    )
+    return pd.DataFrame(rows), separation
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--questions",
+        type=Path,
+        default=APP_FOLDER / "data" / "benchmark_questions.csv",
+        help="CSV file with QUESTION, RELATIVE_PATH, ANSWER and PARAPHRASE columns.",
+    )
+    parser.add_argument(
+        "--chunks",
+        type=Path,
+        help="CSV export of DOCS_CHUNKS_TABLE with RELATIVE_PATH and CHUNK columns. "
+        "The PDFs of the docs folder are chunked when missing.",
+    )
+    parser.add_argument("--num-chunks", type=int, default=10)
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--model", default="mixtral-8x7b")
+    parser.add_argument(
+        "--repeat", type=int, default=20, help="Searches per question."
+    )
+    parser.add_argument(
+        "--min-similarity",
+        type=float,
+        default=0.0,
+        help="Similarity floor of the packed chunks. The app uses "
+        f"{MIN_CONTEXT_SIMILARITY} for e5-base-v2, which the stand-in embedding doesn't reach.",
+    )
+    parser.add_argument(
+        "--max-similarity-drop",
+        type=float,
+        default=MAX_CONTEXT_SIMILARITY_DROP,
+        help="How far below the best chunk a packed chunk can be.",
+    )
+    parser.add_argument(
+        "--calibrate-answer-cache",
+        action="store_true",
+        help="Calibrate the similarity threshold of the answer cache instead.",
+    )
+    parser.add_argument(
+        "--embeddings",
+        type=Path,
+        help="CSV export with TEXT and EMBEDDING columns of the Cortex embeddings of the questions "
+        "and paraphrases, used to calibrate the answer cache. The stand-in embedding is used when missing.",
+    )
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="+",
+        default=[0.85, 0.9, 0.93, 0.95, 0.97, 0.99],
+    )
+    parser.add_argument("--min-word-overlap", type=float, default=0.6)
+    args = parser.parse_args()
+
+    questions = pd.read_csv(args.questions)
+    if args.calibrate_answer_cache:
+        embed = hash_embedding if args.embeddings is None else load_embeddings(args.embeddings)
+        calibration, separation = calibrate_answer_cache(
+            questions, embed, args.thresholds, args.min_word_overlap
+        )
+        print(f"{len(questions)} questions and their paraphrases")
+        print(calibration.round(3).to_string(index=False))
+        print(separation.round(3).to_string())
+        return
+
+    if args.chunks is None:
+        chunks = load_pdf_chunks(APP_FOLDER / "docs")
+    else:
+        chunks = pd.read_csv(args.chunks)
+
+    metrics = run_benchmark(
+        chunks,
+        questions,
+        args.num_chunks,
+        args.k,
+        args.model,
+        args.repeat,
+        args.min_similarity,
+        args.max_similarity_drop,
+    )
+    print(f"{len(questions)} questions, {len(chunks)} chunks")
+    print(metrics.round(3).to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ CREATE DATABASE SampleDatabase;
 USE DATABASE SampleDatabase;
 CREATE SCHEMA RAG_DEMO;
 USE SCHEMA RAG_DEMO;
-CREATE STAGE RAG_DEMO;
+CREATE STAGE RAG_DEMO DIRECTORY = (ENABLE = TRUE);
 
 -----------------------------------------------------
 -- Create Table
@@ -24,6 +24,13 @@ CREATE OR REPLACE TABLE DOCS_SUMMARIES (
     DOC_CONTENT VARCHAR()
 );
 
+CREATE OR REPLACE TABLE DOCS_FILES ( 
+    RELATIVE_PATH VARCHAR(16777216), -- Relative path to the ingested PDF file
+    MD5 VARCHAR(16777216), -- MD5 of the file when it was ingested
+    LAST_MODIFIED TIMESTAMP_TZ, -- Last modification of the file when it was ingested
+    INGESTED_AT TIMESTAMP_TZ
+);  -- Version of every PDF file in DOCS_CHUNKS_TABLE and DOCS_SUMMARIES
+
 -----------------------------------------------------
 -- Create Functions
 -----------------------------------------------------
@@ -123,72 +130,163 @@ def read_file(file_path):
     return pdf_content
 $$;
 
-CREATE OR REPLACE PROCEDURE GET_FILES_SUMMARIES()
+CREATE OR REPLACE PROCEDURE REFRESH_DOCS(BATCH_SIZE NUMBER)
 RETURNS VARCHAR
 LANGUAGE PYTHON
 RUNTIME_VERSION = 3.8
-PACKAGES = ('snowflake-snowpark-python', 'pandas')
-HANDLER='get_summaries'
+PACKAGES = ('snowflake-snowpark-python')
+HANDLER='refresh_docs'
 EXECUTE AS CALLER
 AS
 $$
-import pandas as pd
+import json
+
+# Files of a batch, as a JSON array bound to the queries
+IN_BATCH = "ARRAY_CONTAINS(RELATIVE_PATH::VARIANT, PARSE_JSON(?))"
+
+
+def refresh_docs(session, batch_size):
+    session.sql("ALTER STAGE RAG_DEMO REFRESH").collect()
+
+    # New files, and files whose MD5 (or last modification, when there is no MD5) changed since they were ingested
+    changed_files = session.sql(
+        """
+        SELECT
+            D.RELATIVE_PATH,
+            D.MD5,
+            TO_VARCHAR(D.LAST_MODIFIED, 'YYYY-MM-DD"T"HH24:MI:SS.FF9TZH:TZM') AS LAST_MODIFIED
+        FROM
+            DIRECTORY(@RAG_DEMO) AS D
+            LEFT JOIN DOCS_FILES AS F ON F.RELATIVE_PATH = D.RELATIVE_PATH
+        WHERE
+            F.RELATIVE_PATH IS NULL
+            OR IFF(
+                D.MD5 IS NULL,
+                F.LAST_MODIFIED IS DISTINCT FROM D.LAST_MODIFIED,
+                F.MD5 IS DISTINCT FROM D.MD5
+            )
+        ORDER BY
+            D.RELATIVE_PATH
+        """
+    ).collect()
+
+    # Files that are not in the stage anymore
+    removed_files = json.dumps(
+        [
+            row["RELATIVE_PATH"]
+            for row in session.sql(
+                """
+                SELECT RELATIVE_PATH FROM DOCS_FILES
+                WHERE RELATIVE_PATH NOT IN (SELECT RELATIVE_PATH FROM DIRECTORY(@RAG_DEMO))
+                """
+            ).collect()
+        ]
+    )
+    session.sql("BEGIN").collect()
+    session.sql(f"DELETE FROM DOCS_CHUNKS_TABLE WHERE {IN_BATCH}", params=[removed_files]).collect()
+    session.sql(
+        "DELETE FROM DOCS_SUMMARIES WHERE ARRAY_CONTAINS(DOC_NAME::VARIANT, PARSE_JSON(?))",
+        params=[removed_files],
+    ).collect()
+    session.sql(f"DELETE FROM DOCS_FILES WHERE {IN_BATCH}", params=[removed_files]).collect()
+    session.sql("COMMIT").collect()
 
+    # Every batch is committed on its own, so a failure only reprocesses the files of its batch on the next call
+    for start in range(0, len(changed_files), batch_size):
+        batch = [row.as_dict() for row in changed_files[start : start + batch_size]]
+        batch_files = json.dumps([file["RELATIVE_PATH"] for file in batch])
 
-def get_summaries(session):
-    file_list = session.sql("list @RAG_DEMO").collect()
-    for file in file_list:
-        file_name = file[0].split("/")[1]
-        file_summary = (
+        session.sql("BEGIN").collect()
+        try:
+            session.sql(f"DELETE FROM DOCS_CHUNKS_TABLE WHERE {IN_BATCH}", params=[batch_files]).collect()
             session.sql(
                 f"""
-                SELECT
-                    SNOWFLAKE.CORTEX.SUMMARIZE(
-                        SELECT
-                            GET_PDF_CONTENT(
-                                BUILD_SCOPED_FILE_URL(@RAG_DEMO, '{file_name}')
-                            )
+                INSERT INTO
+                    DOCS_CHUNKS_TABLE (
+                        RELATIVE_PATH,
+                        SIZE,
+                        FILE_URL,
+                        SCOPED_FILE_URL,
+                        CHUNK,
+                        CHUNK_VEC
                     )
+                SELECT
+                    RELATIVE_PATH,
+                    SIZE,
+                    FILE_URL,
+                    BUILD_SCOPED_FILE_URL(@RAG_DEMO, RELATIVE_PATH) AS SCOPED_FILE_URL,
+                    FUNC.CHUNK AS CHUNK,
+                    SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', CHUNK) AS CHUNK_VEC
+                FROM
+                    DIRECTORY(@RAG_DEMO),
+                    TABLE(
+                        PDF_TEXT_CHUNKER(BUILD_SCOPED_FILE_URL(@RAG_DEMO, RELATIVE_PATH))
+                    ) AS FUNC
+                WHERE
+                    {IN_BATCH}
+                """,
+                params=[batch_files],
+            ).collect()
+            session.sql(
+                f"""
+                MERGE INTO DOCS_SUMMARIES AS S
+                USING (
+                    SELECT
+                        RELATIVE_PATH AS DOC_NAME,
+                        SNOWFLAKE.CORTEX.SUMMARIZE(
+                            GET_PDF_CONTENT(BUILD_SCOPED_FILE_URL(@RAG_DEMO, RELATIVE_PATH))
+                        ) AS DOC_CONTENT
+                    FROM
+                        DIRECTORY(@RAG_DEMO)
+                    WHERE
+                        {IN_BATCH}
+                ) AS N
+                ON S.DOC_NAME = N.DOC_NAME
+                WHEN MATCHED THEN UPDATE SET DOC_CONTENT = N.DOC_CONTENT
+                WHEN NOT MATCHED THEN INSERT (DOC_NAME, DOC_CONTENT) VALUES (N.DOC_NAME, N.DOC_CONTENT)
+                """,
+                params=[batch_files],
+            ).collect()
+            # Record the version that was detected, so a file changed in the meantime is processed again
+            session.sql(
                 """
-            )
-            .to_pandas()
-            .iloc[0, 0]
-        )
-        session.sql(
-            f"""
-            INSERT INTO
-                DOCS_SUMMARIES (DOC_NAME, DOC_CONTENT)
-            VALUES
-                ('{file_name}', '{file_summary}')
-            """
-        ).collect()
-
-    return "SUCCESS"
+                MERGE INTO DOCS_FILES AS F
+                USING (
+                    SELECT
+                        VALUE:RELATIVE_PATH::VARCHAR AS RELATIVE_PATH,
+                        VALUE:MD5::VARCHAR AS MD5,
+                        VALUE:LAST_MODIFIED::TIMESTAMP_TZ AS LAST_MODIFIED
+                    FROM
+                        TABLE(FLATTEN(PARSE_JSON(?)))
+                ) AS N
+                ON F.RELATIVE_PATH = N.RELATIVE_PATH
+                WHEN MATCHED THEN UPDATE SET
+                    MD5 = N.MD5,
+                    LAST_MODIFIED = N.LAST_MODIFIED,
+                    INGESTED_AT = CURRENT_TIMESTAMP()
+                WHEN NOT MATCHED THEN INSERT (RELATIVE_PATH, MD5, LAST_MODIFIED, INGESTED_AT)
+                    VALUES (N.RELATIVE_PATH, N.MD5, N.LAST_MODIFIED, CURRENT_TIMESTAMP())
+                """,
+                params=[json.dumps(batch)],
+            ).collect()
+            session.sql("COMMIT").collect()
+        except Exception:
+            session.sql("ROLLBACK").collect()
+            raise
+
+    return f"{len(changed_files)} files ingested, {len(json.loads(removed_files))} files removed"
 $$;
 
 -----------------------------------------------------
 -- Insert from documents
 -----------------------------------------------------
-INSERT INTO
-    DOCS_CHUNKS_TABLE (
-        RELATIVE_PATH,
-        SIZE,
-        FILE_URL,
-        SCOPED_FILE_URL,
-        CHUNK,
-        CHUNK_VEC
-    )
-SELECT
-    RELATIVE_PATH,
-    SIZE,
-    FILE_URL,
-    BUILD_SCOPED_FILE_URL(@RAG_DEMO, RELATIVE_PATH) AS SCOPED_FILE_URL,
-    FUNC.CHUNK AS CHUNK,
-    SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', CHUNK) AS CHUNK_VEC
-FROM
-    DIRECTORY(@RAG_DEMO),
-    TABLE(
-        PDF_TEXT_CHUNKER(BUILD_SCOPED_FILE_URL(@RAG_DEMO, RELATIVE_PATH))
-    ) AS FUNC;
-
-CALL GET_FILES_SUMMARIES();
\ No newline at end of file
+-- Only the new, changed and removed PDFs of the stage are processed, so run it again after uploading files.
+CALL REFRESH_DOCS(10);
+
+-- Optionally, keep the documents fresh with a task:
+-- CREATE OR REPLACE TASK REFRESH_DOCS_TASK
+--     WAREHOUSE = <your_warehouse>
+--     SCHEDULE = '60 MINUTE'
+-- AS
+--     CALL REFRESH_DOCS(10);
+-- ALTER TASK REFRESH_DOCS_TASK RESUME;
@@ -0,0 +1,408 @@
+from threading import Lock, RLock
+from typing import Iterable, List, Optional
+import numpy as np
+import pandas as pd
+import re
+import time
+
+# Below this size scanning the whole matrix is as fast as probing clusters, so no IVF is trained.
+EXACT_SEARCH_MAX_SIZE = 4096
+KMEANS_ITERATIONS = 10
+
+# Words that usually point back to the conversation, so the question can't be searched on its own.
+FOLLOW_UP_RE = re.compile(
+    r"\b(it|its|they|them|their|this|that|these|those|he|she|him|her|one|ones|"
+    r"above|previous|same|former|latter|else|also|more|again)\b",
+    re.IGNORECASE,
+)
+MIN_SELF_CONTAINED_WORDS = 4
+
+# Context window, in tokens, of every model available in the app.
+MODEL_CONTEXT_WINDOWS = {
+    "mixtral-8x7b": 32000,
+    "snowflake-arctic": 4096,
+    "mistral-large": 32000,
+    "llama3-8b": 8000,
+    "llama3-70b": 8000,
+    "reka-flash": 100000,
+    "mistral-7b": 32000,
+    "llama2-70b-chat": 4096,
+    "gemma-7b": 8000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# Upper bound of the context tokens, so large context windows don't turn into large bills.
+# The app used to send two chunks of at most 4000 characters, so this never goes above that.
+MAX_CONTEXT_TOKENS = 2000
+# Chunks below this cosine similarity to the question (on the e5-base-v2 scale), or this far below
+# the best chunk, are not packed even when the budget has room left.
+MIN_CONTEXT_SIMILARITY = 0.75
+MAX_CONTEXT_SIMILARITY_DROP = 0.05
+# Rough token count of English text, good enough for budgeting.
+CHARS_PER_TOKEN = 4
+# Tokens kept free in the prompt for its instructions and for the answer.
+PROMPT_TEMPLATE_TOKENS = 256
+ANSWER_TOKENS = 1024
+# Chunks sharing more than this share of their words with an already packed chunk are skipped.
+DUPLICATE_THRESHOLD = 0.8
+
+WORD_RE = re.compile(r"\w+")
+# Words that don't tell two questions apart, left out when comparing their words.
+QUESTION_STOP_WORDS = frozenset(
+    "a an and are about any at be by can could did do does for from how i in is it me my "
+    "of on or our should some tell that the there they this to us very was we were what "
+    "when where which who why will with you your".split()
+)
+WORD_SUFFIXES = ("ing", "ed", "es", "s", "e")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a question before embedding it, so questions that only differ in case or spacing share the same embedding.
+    The e5-base-v2 model is uncased, so lowercasing doesn't change the embedding.
+    """
+    return " ".join(text.lower().split())
+
+
+def is_self_contained(question: str) -> bool:
+    """
+    Cheap check of whether a question can be answered without the chat history,
+    in which case there is no need to rewrite it with the LLM before retrieving.
+    """
+    return (
+        len(question.split()) >= MIN_SELF_CONTAINED_WORDS
+        and FOLLOW_UP_RE.search(question) is None
+    )
+
+
+def merge_chunks(candidates: List[pd.DataFrame], num_chunks: int) -> pd.DataFrame:
+    """
+    Merge the chunks retrieved for several versions of a question, keeping the best similarity of every chunk.
+    """
+    return (
+        pd.concat(candidates, ignore_index=True)
+        .sort_values("SIMILARITY", ascending=False)
+        .drop_duplicates(subset=["CHUNK"])
+        .head(num_chunks)
+        .reset_index(drop=True)
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a text.
+    """
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def get_context_budget(model: str, reserved_tokens: int) -> int:
+    """
+    Get how many tokens of context fit in the prompt of a model, once the rest of the prompt and the answer are accounted for.
+    """
+    context_window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+    return max(0, min(context_window - reserved_tokens, MAX_CONTEXT_TOKENS))
+
+
+def word_overlap(words: set, other_words: set) -> float:
+    """
+    Share of the words of the smaller set that also are in the other one.
+    """
+    if not words or not other_words:
+        return 0.0
+    return len(words & other_words) / min(len(words), len(other_words))
+
+
+def stem_word(word: str) -> str:
+    """
+    Crude stemming, so that "tested" and "test" or "bikes" and "bike" are the same word.
+    """
+    for suffix in WORD_SUFFIXES:
+        if len(word) > len(suffix) + 2 and word.endswith(suffix):
+            return word[: -len(suffix)]
+    return word
+
+
+def get_content_words(text: str) -> set:
+    """
+    Get the stemmed words of a question that carry its meaning.
+    """
+    words = set(WORD_RE.findall(normalize_text(text))) - QUESTION_STOP_WORDS
+    return {stem_word(word) for word in words}
+
+
+def word_jaccard(words: set, other_words: set) -> float:
+    """
+    Share of the words of both sets that are in both of them.
+    """
+    if not words and not other_words:
+        return 1.0
+    return len(words & other_words) / len(words | other_words)
+
+
+def pack_context(
+    chunks: pd.DataFrame,
+    token_budget: int,
+    min_similarity: float = MIN_CONTEXT_SIMILARITY,
+    max_similarity_drop: float = MAX_CONTEXT_SIMILARITY_DROP,
+) -> pd.DataFrame:
+    """
+    Greedily pick the most similar chunks that fit in the token budget, skipping near-duplicates of chunks already picked
+    and chunks that are weakly related to the question, either below `min_similarity` or more than `max_similarity_drop`
+    below the best chunk.
+    """
+    chunks = chunks.sort_values("SIMILARITY", ascending=False)
+    if chunks.empty:
+        return chunks.reset_index(drop=True)
+    similarity_floor = max(
+        min_similarity, chunks["SIMILARITY"].iloc[0] - max_similarity_drop
+    )
+
+    packed = []
+    packed_words = []
+    used_tokens = 0
+    for index, chunk in chunks[chunks["SIMILARITY"] >= similarity_floor].iterrows():
+        chunk_tokens = estimate_tokens(chunk["CHUNK"])
+        if used_tokens + chunk_tokens > token_budget:
+            continue
+
+        words = set(chunk["CHUNK"].lower().split())
+        if any(
+            word_overlap(words, other) > DUPLICATE_THRESHOLD for other in packed_words
+        ):
+            continue
+
+        packed.append(index)
+        packed_words.append(words)
+        used_tokens += chunk_tokens
+
+    return chunks.loc[packed].reset_index(drop=True)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    L2-normalize the vectors along their last axis, so the cosine similarity becomes a dot product.
+    """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class ChunkIndex:
+    """
+    In-process approximate nearest neighbour index of the chunk embeddings.
+    Vectors are kept normalized in a float32 matrix. Once the index grows past `EXACT_SEARCH_MAX_SIZE`,
+    an inverted file (IVF) of k-means clusters is trained and only the `nprobe` closest clusters are scanned.
+    """
+
+    def __init__(self, dimension: int = 768, nprobe: int = 8) -> None:
+        self.dimension = dimension
+        self.nprobe = nprobe
+        self.lock = RLock()
+        # Held by the session that syncs the index, so it is synced once at a time.
+        self.refresh_lock = Lock()
+        self.ids = np.array([], dtype=object)
+        self.paths = np.array([], dtype=object)
+        self.chunks = np.array([], dtype=object)
+        self.vectors = np.empty((0, dimension), dtype=np.float32)
+        self.centroids = None
+        self.assignments = np.array([], dtype=np.int64)
+        self.trained_size = 0
+        self.refreshed_at = 0.0
+        # Change token of the chunk table the index was last synced with.
+        self.change_token = None
+        # Bumped whenever chunks are added or removed, so answers based on older chunks can be told apart.
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(
+        self,
+        ids: Iterable[str],
+        paths: Iterable[str],
+        chunks: Iterable[str],
+        vectors: np.ndarray,
+    ) -> None:
+        """
+        Add chunks to the index. New vectors join their closest cluster, and the clusters are retrained when the index doubles in size.
+        """
+        vectors = normalize(np.asarray(vectors, dtype=np.float32))
+        with self.lock:
+            self.ids = np.concatenate([self.ids, np.array(list(ids), dtype=object)])
+            self.paths = np.concatenate([self.paths, np.array(list(paths), dtype=object)])
+            self.chunks = np.concatenate([self.chunks, np.array(list(chunks), dtype=object)])
+            self.vectors = np.concatenate([self.vectors, vectors])
+            self.version += 1
+
+            if len(self) > EXACT_SEARCH_MAX_SIZE and len(self) >= 2 * self.trained_size:
+                self._train()
+            elif self.centroids is not None:
+                self.assignments = np.concatenate(
+                    [self.assignments, self._assign(vectors)]
+                )
+
+    def remove(self, ids: Iterable[str]) -> None:
+        """
+        Remove chunks from the index by id.
+        """
+        with self.lock:
+            keep = ~np.isin(self.ids, list(ids))
+            if keep.all():
+                return
+            self.version += 1
+            self.ids = self.ids[keep]
+            self.paths = self.paths[keep]
+            self.chunks = self.chunks[keep]
+            self.vectors = self.vectors[keep]
+            if self.centroids is not None:
+                self.assignments = self.assignments[keep]
+
+    def search(self, query_vector: np.ndarray, k: int) -> pd.DataFrame:
+        """
+        Get the `k` chunks most similar to the query vector, sorted by cosine similarity.
+        """
+        query_vector = normalize(np.asarray(query_vector, dtype=np.float32))
+        with self.lock:
+            if self.centroids is None:
+                candidates = np.arange(len(self))
+            else:
+                probes = np.argsort(self.centroids @ query_vector)[-self.nprobe :]
+                candidates = np.flatnonzero(np.isin(self.assignments, probes))
+
+            similarities = self.vectors[candidates] @ query_vector
+            k = min(k, len(candidates))
+            top = np.argpartition(-similarities, k - 1)[:k] if k > 0 else []
+            top = sorted(top, key=lambda i: -similarities[i])
+
+            return pd.DataFrame(
+                {
+                    "CHUNK": self.chunks[candidates[top]],
+                    "RELATIVE_PATH": self.paths[candidates[top]],
+                    "SIMILARITY": similarities[top],
+                }
+            )
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def _train(self) -> None:
+        """
+        Cluster the vectors with spherical k-means, using about sqrt(n) clusters.
+        """
+        num_clusters = int(np.sqrt(len(self)))
+        rng = np.random.default_rng(0)
+        self.centroids = self.vectors[
+            rng.choice(len(self), num_clusters, replace=False)
+        ]
+        for _ in range(KMEANS_ITERATIONS):
+            self.assignments = self._assign(self.vectors)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, self.assignments, self.vectors)
+            empty = ~sums.any(axis=1)
+            sums[empty] = self.centroids[empty]
+            self.centroids = normalize(sums)
+        self.assignments = self._assign(self.vectors)
+        self.trained_size = len(self)
+
+
+class AnswerCache:
+    """
+    Semantic cache of the answers, so questions close enough to an already answered one are not answered again.
+    A cached answer is reused for the same question, or for a question whose embedding is above the similarity
+    threshold and that shares at least `min_word_overlap` of its content words, as embeddings of questions
+    about different products can be very close. An answer is only reused for the same model and chunk index
+    version, and expires after `ttl_seconds`.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.97,
+        ttl_seconds: float = 86400,
+        max_size: int = 1024,
+        min_word_overlap: float = 0.6,
+        dimension: int = 768,
+    ) -> None:
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.min_word_overlap = min_word_overlap
+        self.lock = RLock()
+        self.vectors = np.empty((0, dimension), dtype=np.float32)
+        self.questions = np.array([], dtype=object)
+        self.models = np.array([], dtype=object)
+        self.versions = np.array([], dtype=np.int64)
+        self.created_at = np.array([], dtype=np.float64)
+        self.answers = []
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    def lookup(
+        self, question: str, query_vector: np.ndarray, model: str, version: int
+    ) -> Optional[str]:
+        """
+        Get the answer of the same question, or else of the most similar cached question
+        above the threshold that also shares enough of its words.
+        """
+        question = normalize_text(question)
+        query_vector = normalize(np.asarray(query_vector, dtype=np.float32))
+        with self.lock:
+            self._evict(version)
+            valid = self.models == model
+            if not valid.any():
+                return None
+
+            same_question = np.flatnonzero(valid & (self.questions == question))
+            if len(same_question):
+                return self.answers[same_question[-1]]
+
+            similarities = np.where(valid, self.vectors @ query_vector, -1.0)
+            candidates = np.flatnonzero(similarities >= self.threshold)
+            content_words = get_content_words(question)
+            for candidate in candidates[np.argsort(-similarities[candidates])]:
+                candidate_words = get_content_words(self.questions[candidate])
+                if word_jaccard(content_words, candidate_words) >= self.min_word_overlap:
+                    return self.answers[candidate]
+
+            return None
+
+    def store(
+        self,
+        question: str,
+        query_vector: np.ndarray,
+        model: str,
+        version: int,
+        answer: str,
+    ) -> None:
+        """
+        Cache the answer of a question. The oldest answers are dropped once the cache is full.
+        """
+        query_vector = normalize(np.asarray(query_vector, dtype=np.float32))
+        with self.lock:
+            self._evict(version)
+            self.vectors = np.concatenate([self.vectors, query_vector[np.newaxis]])
+            self.questions = np.append(
+                self.questions, np.array([normalize_text(question)], dtype=object)
+            )
+            self.models = np.append(self.models, np.array([model], dtype=object))
+            self.versions = np.append(self.versions, version)
+            self.created_at = np.append(self.created_at, time.time())
+            self.answers.append(answer)
+            if len(self) > self.max_size:
+                self._keep(np.arange(len(self)) >= len(self) - self.max_size)
+
+    def _evict(self, version: int) -> None:
+        """
+        Drop the answers that expired or are based on another version of the chunks.
+        """
+        keep = (self.versions == version) & (
+            time.time() - self.created_at < self.ttl_seconds
+        )
+        if not keep.all():
+            self._keep(keep)
+
+    def _keep(self, keep: np.ndarray) -> None:
+        self.vectors = self.vectors[keep]
+        self.questions = self.questions[keep]
+        self.models = self.models[keep]
+        self.versions = self.versions[keep]
+        self.created_at = self.created_at[keep]
+        self.answers = [answer for answer, kept in zip(self.answers, keep) if kept]
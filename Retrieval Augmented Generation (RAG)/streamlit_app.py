@@ -1,15 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from retrieval import (
+    ANSWER_TOKENS,
+    PROMPT_TEMPLATE_TOKENS,
+    AnswerCache,
+    ChunkIndex,
+    estimate_tokens,
+    get_context_budget,
+    is_self_contained,
+    merge_chunks,
+    normalize_text,
+    pack_context,
+)
 from snowflake.cortex import Complete
 from snowflake.snowpark import Session
 from snowflake.snowpark.context import get_active_session
-from typing import Dict, List
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+import json
+import numpy as np
+import pandas as pd
 import pypdfium2 as pdfium
 import streamlit as st
+import time
 
 st.set_page_config(layout="wide")
 
 session: Session = get_active_session()
 
+# Width, in pixels, PDF pages are rendered at: about twice the width they are displayed with, for high density screens.
+PAGE_RENDER_WIDTH = 1200
+# How many rendered pages are kept in memory.
+PAGE_CACHE_SIZE = 256
+THUMBNAIL_WIDTH = 96
+THUMBNAIL_STRIP_SIZE = 6
+# How often the vector index checks `DOCS_CHUNKS_TABLE` for new or removed chunks.
+CHUNK_INDEX_REFRESH_SECONDS = 300
+# Chunks have no key column, so they are identified by a hash of their file and text.
+CHUNK_ID_COLUMN = "TO_VARCHAR(HASH(RELATIVE_PATH, CHUNK))"
+# How many distinct question embeddings are kept in memory.
+EMBEDDING_CACHE_SIZE = 1024
+# Num-chunks retrieved as candidates for the context. Play with this to check how it affects your accuracy.
+NUM_CANDIDATE_CHUNKS = 10
+# Questions at least this similar to an answered one get the cached answer, for as long as the chunks don't change.
+ANSWER_CACHE_SIMILARITY = 0.97
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+ANSWER_CACHE_SIZE = 1024
+# Share of content words a similar question must have in common with the answered one, as embeddings of
+# questions about different products can be very close. Calibrated with `benchmark.py --calibrate-answer-cache`.
+ANSWER_CACHE_MIN_WORD_OVERLAP = 0.6
+
 
 @st.cache_data(show_spinner=False)
 def get_files_summaries(_session: Session) -> Dict[str, str]:
@@ -41,28 +82,149 @@ def get_pdf_bytes(_session: Session, file_name: str) -> bytes:
     return bytes
 
 
-def view_pdf_page(session: Session, file_name: str) -> None:
+@st.cache_resource(show_spinner=False)
+def get_pdfium_lock() -> Lock:
+    """
+    Get the lock every thread renders PDF pages with, as pdfium is not thread safe.
+    """
+    return Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def get_render_pool() -> ThreadPoolExecutor:
+    """
+    Get the thread pool that pre-renders the thumbnails in the background.
+    """
+    return ThreadPoolExecutor(max_workers=1)
+
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_document(_session: Session, file_name: str) -> pdfium.PdfDocument:
+    """
+    Get the opened PDF document, so it isn't parsed again on every rerun.
+    It is opened under the pdfium lock, as the thumbnails of another PDF may be rendering.
+    """
+    pdf_bytes = get_pdf_bytes(_session, file_name)
+    with get_pdfium_lock():
+        return pdfium.PdfDocument(BytesIO(pdf_bytes))
+
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_page_count(_session: Session, file_name: str) -> int:
+    """
+    Get the number of pages of the PDF, read once under the pdfium lock as the thumbnails may be rendering.
+    """
+    with get_pdfium_lock():
+        return len(get_pdf_document(_session, file_name))
+
+
+def render_page_image(
+    pdf: pdfium.PdfDocument, lock: Lock, page_number: int, width: int, quality: int
+) -> bytes:
+    """
+    Render a PDF page `width` pixels wide, as a JPEG image.
+    The page and its bitmap are closed under the lock, instead of by their finalizers on any thread.
+    """
+    with lock:
+        page = pdf[page_number]
+        try:
+            bitmap = page.render(scale=width / page.get_width())
+            try:
+                # Copies the pixels, as the PIL image of the bitmap shares its buffer
+                pil_image = bitmap.to_pil().convert("RGB")
+            finally:
+                bitmap.close()
+        finally:
+            page.close()
+
+    image = BytesIO()
+    pil_image.save(image, format="JPEG", quality=quality)
+    return image.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=PAGE_CACHE_SIZE)
+def get_page_image(
+    _pdf: pdfium.PdfDocument, file_name: str, page_number: int, width: int
+) -> bytes:
+    """
+    Get a PDF page rendered as an image, rendering every (file, page, width) only once.
     """
-    Render a selected PDF page as an image.
+    return render_page_image(_pdf, get_pdfium_lock(), page_number, width, 85)
+
+
+def render_thumbnails(
+    pdf: pdfium.PdfDocument, lock: Lock, num_pages: int, thumbnails: Dict[int, bytes]
+) -> None:
+    for page_number in range(num_pages):
+        thumbnails[page_number] = render_page_image(
+            pdf, lock, page_number, THUMBNAIL_WIDTH, 70
+        )
+
+
+@st.cache_resource(show_spinner=False)
+def get_thumbnails(_session: Session, file_name: str) -> Dict[int, bytes]:
+    """
+    Get the thumbnails of the PDF pages. They are rendered in the background the first time the PDF is viewed,
+    and show up in the thumbnail strip as they become available.
     """
-    # Gets PDF bytes, then transformed into a more usable object such as `PdfDocument`.
-    file_byte = get_pdf_bytes(session, file_name)
-    pdf = pdfium.PdfDocument(BytesIO(file_byte))
+    thumbnails = {}
+    get_render_pool().submit(
+        render_thumbnails,
+        get_pdf_document(_session, file_name),
+        get_pdfium_lock(),
+        get_pdf_page_count(_session, file_name),
+        thumbnails,
+    )
+    return thumbnails
+
+
+def select_pdf_page(page_key: str, page_number: int) -> None:
+    st.session_state[page_key] = page_number
 
-    # Get the number of pages to render a select to choose from.
-    page_num_arr = {}
-    for page_number in range(0, len(pdf)):
-        page_num_arr["Page " + str(page_number + 1)] = page_number
 
+def view_pdf_page(session: Session, file_name: str) -> None:
+    """
+    Render a selected PDF page as an image, with a strip of thumbnails of the pages around it.
+    """
+    pdf = get_pdf_document(session, file_name)
+    thumbnails = get_thumbnails(session, file_name)
+    num_pages = get_pdf_page_count(session, file_name)
+
+    page_key = f"sel_pdf_page_{file_name}"
     selected_page = st.selectbox(
-        "Select the page that you want to see:", page_num_arr.keys()
+        "Select the page that you want to see:",
+        range(num_pages),
+        format_func=lambda page_number: f"Page {page_number + 1}",
+        key=page_key,
     )
 
-    # Render the selected page of the PDF.
-    page = pdf.get_page(page_num_arr[selected_page])
-    pil_image = page.render(scale=300 / 72).to_pil()
+    # Render the selected page of the PDF, at the resolution it is displayed with.
     with st.container(height=345, border=False):
-        st.image(pil_image, use_column_width="always")
+        st.image(
+            get_page_image(pdf, file_name, selected_page, PAGE_RENDER_WIDTH),
+            use_column_width="always",
+        )
+
+    # Thumbnails of the pages around the selected one, with a button to jump to each of them.
+    first_page = max(
+        0,
+        min(
+            selected_page - THUMBNAIL_STRIP_SIZE // 2,
+            num_pages - THUMBNAIL_STRIP_SIZE,
+        ),
+    )
+    strip_pages = range(first_page, min(num_pages, first_page + THUMBNAIL_STRIP_SIZE))
+    for column, page_number in zip(st.columns(THUMBNAIL_STRIP_SIZE), strip_pages):
+        if page_number in thumbnails:
+            column.image(thumbnails[page_number], use_column_width="always")
+        column.button(
+            str(page_number + 1),
+            key=f"btn_pdf_page_{file_name}_{page_number}",
+            on_click=select_pdf_page,
+            args=(page_key, page_number),
+            disabled=page_number == selected_page,
+            use_container_width=True,
+        )
 
 
 def display_pdf_summary(session: Session) -> None:
@@ -85,49 +247,190 @@ def display_pdf_summary(session: Session) -> None:
         view_pdf_page(session, selected_summary)
 
 
-def get_similar_chunks_query(question: str, num_chunks: int) -> str:
+@st.cache_resource(show_spinner=False)
+def get_chunk_index(_session: Session) -> ChunkIndex:
+    """
+    Get the in-process vector index of `DOCS_CHUNKS_TABLE`, shared by every session of the app.
+    """
+    return ChunkIndex()
+
+
+def get_chunks_change_token(session: Session) -> int:
+    """
+    Get a token that changes whenever `DOCS_CHUNKS_TABLE` changes. It is read from the metadata, without a warehouse.
+    """
+    return session.sql(
+        "SELECT SYSTEM$LAST_CHANGE_COMMIT_TIME('DOCS_CHUNKS_TABLE');"
+    ).collect()[0][0]
+
+
+def refresh_chunk_index(
+    session: Session, chunk_index: ChunkIndex, force: bool = False
+) -> None:
     """
-    Get similarity bewteen the question and the information
-    available in the PDFs.
+    Sync the vector index with `DOCS_CHUNKS_TABLE` every `CHUNK_INDEX_REFRESH_SECONDS`, or right away when forced.
+    Only the chunk ids are compared, so the embeddings are fetched just for the chunks that are not indexed yet.
+    The index is only locked to apply the changes, so searches don't wait for the warehouse,
+    and a single session refreshes it at a time while the others keep searching the current chunks.
     """
-    return f"""
-            WITH RESULTS AS (
+    if (
+        not force
+        and time.time() - chunk_index.refreshed_at < CHUNK_INDEX_REFRESH_SECONDS
+    ):
+        return
+    if not chunk_index.refresh_lock.acquire(blocking=False):
+        return
+
+    try:
+        # Read before the chunks, so a change made while syncing is caught by the next check
+        change_token = get_chunks_change_token(session)
+        chunk_ids = set(
+            session.sql(
+                f"SELECT DISTINCT {CHUNK_ID_COLUMN} AS CHUNK_ID FROM DOCS_CHUNKS_TABLE;"
+            )
+            .to_pandas()["CHUNK_ID"]
+            .astype(str)
+        )
+        indexed_ids = set(chunk_index.ids)
+        new_ids = chunk_ids - indexed_ids
+
+        new_chunks = None
+        if new_ids:
+            # An empty index loads the whole table, otherwise the new ids are joined as a table
+            new_ids_join = (
+                ""
+                if not indexed_ids
+                else "INNER JOIN TABLE(FLATTEN(PARSE_JSON(?))) AS NEW_IDS "
+                f"ON {CHUNK_ID_COLUMN} = NEW_IDS.VALUE::VARCHAR"
+            )
+            new_chunks = session.sql(
+                f"""
                 SELECT
+                    {CHUNK_ID_COLUMN} AS CHUNK_ID,
                     RELATIVE_PATH,
-                    VECTOR_COSINE_SIMILARITY(
-                        DOCS_CHUNKS_TABLE.CHUNK_VEC,
-                        SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', '{question.replace("'", "")}')
-                    ) AS SIMILARITY,
-                    CHUNK
+                    CHUNK,
+                    CHUNK_VEC::ARRAY AS CHUNK_VEC
                 FROM
                     DOCS_CHUNKS_TABLE
-                ORDER BY
-                    SIMILARITY DESC
-                LIMIT
-                    {num_chunks}
+                    {new_ids_join}
+                QUALIFY
+                    ROW_NUMBER() OVER (PARTITION BY CHUNK_ID ORDER BY RELATIVE_PATH) = 1;
+                """,
+                params=[json.dumps(sorted(new_ids))] if indexed_ids else None,
+            ).to_pandas()
+            new_vectors = np.array(
+                [json.loads(vector) for vector in new_chunks["CHUNK_VEC"]],
+                dtype=np.float32,
             )
-            SELECT
-                CHUNK,
-                RELATIVE_PATH
-            FROM
-                RESULTS;
-            """
+
+        with chunk_index.lock:
+            chunk_index.remove(indexed_ids - chunk_ids)
+            if new_chunks is not None:
+                chunk_index.add(
+                    new_chunks["CHUNK_ID"].astype(str),
+                    new_chunks["RELATIVE_PATH"],
+                    new_chunks["CHUNK"],
+                    new_vectors,
+                )
+            chunk_index.refreshed_at = time.time()
+            chunk_index.change_token = change_token
+    finally:
+        chunk_index.refresh_lock.release()
+
+
+@st.cache_data(show_spinner=False, max_entries=EMBEDDING_CACHE_SIZE)
+def embed_text(_session: Session, text: str) -> np.ndarray:
+    """
+    Embed a text with the same model used for the chunks. The least recently used embeddings are evicted once the cache is full.
+    """
+    embedding = _session.sql(
+        "SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', ?)::ARRAY;",
+        params=[text],
+    ).collect()[0][0]
+    return np.array(json.loads(embedding), dtype=np.float32)
+
+
+def get_question_embedding(session: Session, question: str) -> np.ndarray:
+    """
+    Embed the question, only once per distinct normalized question.
+    """
+    return embed_text(session, normalize_text(question))
+
+
+def search_similar_chunks(session: Session, question: str) -> pd.DataFrame:
+    """
+    Looks up the most similar text chunks for a given question in the in-process vector index.
+    """
+    chunk_index = get_chunk_index(session)
+    refresh_chunk_index(session, chunk_index)
+    return chunk_index.search(
+        get_question_embedding(session, question), NUM_CANDIDATE_CHUNKS
+    )
 
 
-def get_similar_chunks(session: Session, question: str) -> str:
+@st.cache_resource(show_spinner=False)
+def get_answer_cache(_session: Session) -> AnswerCache:
     """
-    Executes the SQL query generated by get_similar_chunks_query and retrieves the most similar text chunks for a given question.
+    Get the semantic cache of the answers, shared by every session of the app.
     """
-    num_chunks = 3  # Num-chunks provided as context. Play with this to check how it affects your accuracy.
-    chunks = session.sql(get_similar_chunks_query(question, num_chunks)).to_pandas()
-    chunks_length = len(chunks) - 1
-    similar_chunks = ""
-    for i in range(0, chunks_length):
-        similar_chunks += str(
-            chunks.iloc[i, 0]
-        )  # Gets chunks values from the dataframe (Chunks is the first column).
+    return AnswerCache(
+        ANSWER_CACHE_SIMILARITY,
+        ANSWER_CACHE_TTL_SECONDS,
+        ANSWER_CACHE_SIZE,
+        ANSWER_CACHE_MIN_WORD_OVERLAP,
+    )
+
+
+def get_cached_answer(
+    session: Session, question: str, model: str
+) -> Optional[str]:
+    """
+    Get the cached answer of a similar question, if any. Only questions that don't refer
+    to the conversation are cached, as their answer doesn't depend on the chat history.
+    The index is synced first if the chunks changed, so answers about re-ingested documents
+    are not served until the index catches up.
+    """
+    if not is_self_contained(question):
+        return None
+
+    chunk_index = get_chunk_index(session)
+    change_token = get_chunks_change_token(session)
+    if change_token != chunk_index.change_token:
+        refresh_chunk_index(session, chunk_index, force=True)
+        if change_token != chunk_index.change_token:
+            # Another session is syncing the index
+            return None
+
+    return get_answer_cache(session).lookup(
+        question,
+        get_question_embedding(session, question),
+        model,
+        chunk_index.version,
+    )
+
+
+def cache_answer(
+    session: Session, question: str, model: str, version: int, answer: str
+) -> None:
+    """
+    Cache the answer of a question that doesn't refer to the conversation,
+    under the version of the chunk index its context was retrieved from.
+    """
+    if is_self_contained(question):
+        get_answer_cache(session).store(
+            question,
+            get_question_embedding(session, question),
+            model,
+            version,
+            answer,
+        )
 
-    return similar_chunks
+
+def get_similar_chunks(chunks: pd.DataFrame, token_budget: int) -> str:
+    """
+    Packs the retrieved chunks that fit in the token budget into the context of the prompt.
+    """
+    return "\n\n".join(pack_context(chunks, token_budget)["CHUNK"].astype(str))
 
 
 def init_messages():
@@ -186,21 +489,49 @@ def summarize_question_with_history(
     return summary
 
 
-def get_cortex_prompt(question: str, model: str, session: Session) -> str:
+def get_cortex_prompt(question: str, model: str, session: Session) -> Tuple[str, bool]:
     """
     Creates cortex prompt, based on the given text but also keeping in mind the coversation context.
+    Also tells whether the history had any question of the user, as the answer then depends on the conversation.
     """
     chat_history = get_chat_history()
-
-    if chat_history != []:
-        question_summary = summarize_question_with_history(
-            chat_history, question, model
-        )
-        prompt_context = get_similar_chunks(session, question_summary)
+    has_conversation = any(message["role"] == "user" for message in chat_history)
+
+    if chat_history != [] and not is_self_contained(question):
+        # Retrieve on the raw question while the LLM rewrites it with the chat history,
+        # then keep the best chunks of both searches. The worker gets the context of the script run,
+        # as the search uses the cached embeddings.
+        with ThreadPoolExecutor(
+            max_workers=1,
+            initializer=add_script_run_ctx,
+            initargs=(None, get_script_run_ctx()),
+        ) as executor:
+            raw_question_chunks = executor.submit(
+                search_similar_chunks, session, question
+            )
+            question_summary = summarize_question_with_history(
+                chat_history, question, model
+            )
+            chunks = merge_chunks(
+                [
+                    raw_question_chunks.result(),
+                    search_similar_chunks(session, question_summary),
+                ],
+                NUM_CANDIDATE_CHUNKS,
+            )
     else:
-        prompt_context = get_similar_chunks(
-            session, question
-        )  # First question when using history
+        # First question, or a question that doesn't refer to the conversation
+        chunks = search_similar_chunks(session, question)
+
+    # Whatever is left of the context window after the history, the question and the answer
+    reserved_tokens = (
+        estimate_tokens(f"{chat_history}{question}")
+        + PROMPT_TEMPLATE_TOKENS
+        + ANSWER_TOKENS
+    )
+    prompt_context = get_similar_chunks(
+        chunks, get_context_budget(model, reserved_tokens)
+    )
 
     prompt = f"""
            You are an expert chat assistance that extracts information from the CONTEXT provided
@@ -226,7 +557,7 @@ def get_cortex_prompt(question: str, model: str, session: Session) -> str:
            Answer: 
            """
 
-    return prompt
+    return prompt, has_conversation
 
 
 st.title(f"Retrieval Augmented Generation 💬")
@@ -281,12 +612,23 @@ with chat_col:
         # Display assistant response in chat message container
         with messages_container.chat_message("assistant"):
             response = ""
-            question = question.replace("'", "")
             with st.spinner(f"{model_name} thinking..."):
-                response = Complete(
-                    model_name,
-                    get_cortex_prompt(question, model_name, session),
-                )
+                response = get_cached_answer(session, question, model_name)
+                if response is None:
+                    prompt, has_conversation = get_cortex_prompt(
+                        question, model_name, session
+                    )
+                    chunks_version = get_chunk_index(session).version
+
+            if response is None:
+                # Write the answer token by token, as the model generates it
+                response = st.write_stream(Complete(model_name, prompt, stream=True))
+                # Answers that depend on this conversation are not shared with other sessions
+                if not has_conversation:
+                    cache_answer(
+                        session, question, model_name, chunks_version, response
+                    )
+            else:
                 st.markdown(response)
 
         st.session_state.messages.append({"role": "assistant", "content": response})
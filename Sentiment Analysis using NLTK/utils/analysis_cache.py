@@ -0,0 +1,102 @@
+from typing import Dict, List
+
+import json
+import sqlite3
+
+# Local store for the per-tweet analysis, so a tweet goes through TextBlob only once.
+# Bump the table version whenever the cleaning or the analysis changes.
+ANALYSIS_CACHE_PATH = "/tmp/airtweet_analysis.sqlite"
+ANALYSIS_CACHE_TABLE = "tweet_analysis_v2"
+TERM_FIELDS = ("words", "noun_phrases")
+
+# SQLite limits the number of bound variables per statement
+_MAX_QUERY_PARAMS = 500
+
+
+def _connect() -> sqlite3.Connection:
+    """Opens the analysis cache, creating its table if needed.
+
+    Returns:
+        sqlite3.Connection: A connection to the analysis cache.
+    """
+    connection = sqlite3.connect(ANALYSIS_CACHE_PATH, timeout=30)
+    connection.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {ANALYSIS_CACHE_TABLE} (
+            tweet_id TEXT PRIMARY KEY,
+            clean_text TEXT,
+            polarity REAL,
+            subjectivity REAL,
+            words TEXT,
+            noun_phrases TEXT
+        )
+        """
+    )
+    return connection
+
+
+def load_tweet_analyses(tweet_ids: List[str]) -> Dict[str, dict]:
+    """Loads the cached analysis of the given tweets.
+
+    Args:
+        tweet_ids (List[str]): The ids of the tweets to look up.
+
+    Returns:
+        Dict[str, dict]: The cached analyses by tweet id. Tweets that
+    were never analysed are not included.
+    """
+    analyses = {}
+    connection = _connect()
+    try:
+        for start in range(0, len(tweet_ids), _MAX_QUERY_PARAMS):
+            ids_chunk = tweet_ids[start : start + _MAX_QUERY_PARAMS]
+            rows = connection.execute(
+                f"""
+                SELECT
+                    tweet_id, clean_text, polarity, subjectivity, {", ".join(TERM_FIELDS)}
+                FROM
+                    {ANALYSIS_CACHE_TABLE}
+                WHERE
+                    tweet_id IN ({", ".join("?" for _ in ids_chunk)})
+                """,
+                ids_chunk,
+            )
+            for tweet_id, clean_text, polarity, subjectivity, *terms in rows:
+                analyses[tweet_id] = {
+                    "clean_text": clean_text,
+                    "polarity": polarity,
+                    "subjectivity": subjectivity,
+                    **{
+                        field: json.loads(value)
+                        for field, value in zip(TERM_FIELDS, terms)
+                    },
+                }
+    finally:
+        connection.close()
+    return analyses
+
+
+def store_tweet_analyses(analyses: Dict[str, dict]) -> None:
+    """Stores the analysis of the given tweets, replacing older entries.
+
+    Args:
+        analyses (Dict[str, dict]): The analyses by tweet id.
+    """
+    connection = _connect()
+    try:
+        with connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO {ANALYSIS_CACHE_TABLE} VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        tweet_id,
+                        analysis["clean_text"],
+                        analysis["polarity"],
+                        analysis["subjectivity"],
+                        *(json.dumps(analysis[field]) for field in TERM_FIELDS),
+                    )
+                    for tweet_id, analysis in analyses.items()
+                ),
+            )
+    finally:
+        connection.close()
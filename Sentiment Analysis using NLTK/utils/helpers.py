@@ -20,30 +20,6 @@ def rel_to_abs_date(days: Union[None, int]) -> datetime.date:
     return return_data
 
 
-def add_counts(accumulator: dict, ngrams: dict) -> None:
-    """Add counts to the accumulator.
-
-    Args:
-        accumulator (dict): The acumulator as a dictionary.
-        ngrams (dict): The ngrams as dictionary.
-    """
-    for ngram, count in ngrams.items():
-        accumulator[ngram] += count
-
-
-def get_counts(blobfield: list, key_sep: str) -> dict:
-    """Gets the couns for the blob using the provided key.
-
-    Args:
-        blobfield (list): The blobfield.
-        key_sep (str): The key separator.
-
-    Returns:
-        dict: A dictionary with the blobfields as keys.
-    """
-    return {key_sep.join(x): blobfield.count(x) for x in blobfield}
-
-
 def get_relative_dates() -> dict:
     """Get relative dates as a dictionary.
 
@@ -1,27 +1,110 @@
-from textblob.download_corpora import download_all
+from utils.data_access import get_snowflake_session
+
+from threading import Lock
+
+import logging
 import nltk
 import os
+import shutil
 import streamlit as st
+import tempfile
+import zipfile
+
+logger = logging.getLogger(__name__)
 
 # We will use a temporary location for the downloaded dependencies
 DOWNLOAD_FOLDER = "/tmp/nlkt_data"
 
+# Optional stage archive with a prepared nltk data folder (containing the
+# "corpora" and "tokenizers" folders), e.g. "@my_stage/nltk_data.zip".
+# When set, it is used instead of downloading from nltk.org.
+NLTK_DATA_STAGE_ARCHIVE = None
+
+# The only ntlk resources the app uses, with the path nltk finds them by:
+# stopwords for the tweet cleaning, punkt for the TextBlob tokenizers and
+# brown for the TextBlob noun phrase extractor.
+NLTK_RESOURCES = {
+    "stopwords": "corpora/stopwords",
+    "punkt": "tokenizers/punkt",
+    "punkt_tab": "tokenizers/punkt_tab",
+    "brown": "corpora/brown",
+}
+TEXTBLOB_RESOURCES = ["punkt", "punkt_tab", "brown"]
+
+
+@st.cache_resource(show_spinner=False)
+def get_nltk_data_lock() -> Lock:
+    """Gets the lock the sessions install the ntlk data under, so they
+    don't install it at the same time.
+
+    Returns:
+        Lock: A lock shared by the app sessions.
+    """
+    return Lock()
+
+
+def install_stage_archive() -> None:
+    """Extracts the stage archive into a temporary folder next to
+    DOWNLOAD_FOLDER and moves it in place, so a failed download or
+    extraction never leaves the ntlk data half installed.
+    """
+    work_folder = tempfile.mkdtemp(dir=os.path.dirname(DOWNLOAD_FOLDER))
+    try:
+        get_snowflake_session().file.get(NLTK_DATA_STAGE_ARCHIVE, work_folder)
+        archive_name = os.path.basename(NLTK_DATA_STAGE_ARCHIVE)
+        extract_folder = os.path.join(work_folder, "nltk_data")
+        with zipfile.ZipFile(os.path.join(work_folder, archive_name)) as archive:
+            archive.extractall(extract_folder)
+        os.replace(extract_folder, DOWNLOAD_FOLDER)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
 
 def download_ntlk_depencies() -> None:
-    """Download ntlk library dependencies. This will be done only
-    the first time the app is booted.
+    """Preloads the ntlk data from the stage archive, if there is one. This will
+    be done only the first time the app is booted. Otherwise, or when the
+    archive can't be installed, every resource is downloaded on its first use.
+    """
+    if DOWNLOAD_FOLDER not in nltk.data.path:
+        nltk.data.path.append(DOWNLOAD_FOLDER)
+
+    if NLTK_DATA_STAGE_ARCHIVE is None or os.path.exists(DOWNLOAD_FOLDER):
+        return
+
+    with st.spinner("Loading library data!"), get_nltk_data_lock():
+        if os.path.exists(DOWNLOAD_FOLDER):
+            return
+        try:
+            install_stage_archive()
+        except Exception:
+            logger.warning(
+                "Could not install the ntlk data from %s, downloading it instead",
+                NLTK_DATA_STAGE_ARCHIVE,
+                exc_info=True,
+            )
+
+
+def download_ntlk_resource(name: str) -> None:
+    """Downloads a ntlk resource, unless it is already available.
+
+    Args:
+        name (str): The resource name, one of NLTK_RESOURCES.
     """
-    if not os.path.exists(DOWNLOAD_FOLDER):
-        with st.spinner("Downloading library data!"):
-            os.makedirs(DOWNLOAD_FOLDER)
-            # Here we override the download directory path for
-            # the textblob.download_corpora.download_all method
-            nltk.downloader._downloader.download_dir = DOWNLOAD_FOLDER
-            download_all()
+    if DOWNLOAD_FOLDER not in nltk.data.path:
+        nltk.data.path.append(DOWNLOAD_FOLDER)
+    try:
+        nltk.data.find(NLTK_RESOURCES[name])
+    except LookupError:
+        with get_nltk_data_lock():
+            nltk.download(name, download_dir=DOWNLOAD_FOLDER, quiet=True)
 
 
 def download_stopwords():
     """Downloads ntlk stopwords package."""
-    if not os.path.exists(f"{DOWNLOAD_FOLDER}/corpora/stopwords"):
-        nltk.data.path = [DOWNLOAD_FOLDER]
-        nltk.download("stopwords")
+    download_ntlk_resource("stopwords")
+
+
+def download_textblob_corpora():
+    """Downloads the ntlk packages used by the TextBlob analysis."""
+    for name in TEXTBLOB_RESOURCES:
+        download_ntlk_resource(name)
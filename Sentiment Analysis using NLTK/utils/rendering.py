@@ -1,6 +1,7 @@
 from math import floor
 from typing import List, Union
 import altair as alt
+import numpy as np
 import pandas as pd
 import streamlit as st
 
@@ -91,3 +92,108 @@ def chart_mark_point(
     )
 
     return encode_chart(c_mark_point, time_unit, field, title, scale)
+
+
+def display_sentiment(
+    sentiment_df: pd.DataFrame, time_unit: str, show_subjectivity: bool
+) -> None:
+    """Display the sentiment metrics and the polarity and subjectivity charts.
+
+    Args:
+        sentiment_df (pd.DataFrame): The date, polarity and subjectivity of the tweets,
+         and their number of tweets when every row aggregates several of them.
+        time_unit (str): The time unit as a string.
+        show_subjectivity (bool): Whether the subjectivity is available and displayed.
+    """
+    col_a, col_b = st.columns(2)
+
+    # Rows that aggregate several tweets count as many times as their number of tweets
+    weighted = "num_tweets" in sentiment_df
+    weights = sentiment_df["num_tweets"] if weighted else None
+    mean_polarity = np.average(sentiment_df["polarity"], weights=weights)
+    col_a.metric("POLARITY", f"{mean_polarity:.2f}", delta=f"{mean_polarity:2f}")
+    if show_subjectivity:
+        mean_subjectivity = sentiment_df["subjectivity"].mean()
+        col_b.metric(
+            "SUBJECTIVITY", f"{mean_subjectivity:.2f}", delta=f"{mean_subjectivity:2f}"
+        )
+
+    chart = alt.Chart(sentiment_df, title="")
+    if weighted:
+        weighted_chart = (
+            chart.transform_timeunit(date=f"{time_unit}(date)")
+            .transform_calculate(weighted_polarity="datum.polarity * datum.num_tweets")
+            .transform_aggregate(
+                weighted_polarity="sum(weighted_polarity)",
+                num_tweets="sum(num_tweets)",
+                groupby=["date"],
+            )
+            .transform_calculate(polarity="datum.weighted_polarity / datum.num_tweets")
+        )
+        avg_polarity = chart_mark_line(
+            weighted_chart, time_unit, "polarity:Q", "polarity", [-1, 1]
+        )
+    else:
+        avg_polarity = chart_mark_line(
+            chart, time_unit, "mean(polarity):Q", "polarity", [-1, 1]
+        )
+    polarity_values = chart_mark_point(chart, time_unit, "polarity:Q", "polarity", None)
+
+    with st.expander("Sentiment Polarity"):
+        st.write(
+            """
+            Sentiment polarity, in the context of sentiment analysis, refers to the degree of
+            positivity, neutrality, or negativity expressed in a piece of text. 
+            
+            Scores closer to 1 indicate strong positive sentiment, reflecting expressions of 
+            joy, enthusiasm, or satisfaction, such as "I'm very pleased with my flight!"
+            
+            Conversely, scores closer to -1 signify strong negative sentiment, capturing emotions 
+            of disappointment, frustration, or anger, as in "The service was terrible, and 
+            I'm extremely dissatisfied."
+            
+            In contrast, scores close to 0 denote neutral sentiment, indicating a lack of emotional
+            bias or a balanced viewpoint, like "The flight went as expected!" 
+            
+            Sentiment polarity analysis is valuable for understanding the overall emotional tone 
+            conveyed in textual data, enabling insights into public opinion, customer feedback, and
+            social media sentiment, among other applications.
+            """
+        )
+    st.altair_chart(avg_polarity + polarity_values, use_container_width=True)
+
+    if show_subjectivity:
+        avg_subjectivity = chart_mark_line(
+            chart, time_unit, "mean(subjectivity):Q", "subjectivity", [0, 1]
+        )
+        subjectivity_values = chart_mark_point(
+            chart, time_unit, "subjectivity:Q", "subjectivity", None
+        )
+
+        with st.expander("Sentiment Subjectivity"):
+            st.write(
+                """
+                Sentiment subjectivity refers to the degree to which 
+                opinions expressed about the airline are influenced by personal experiences, 
+                emotions, or biases rather than objective facts.
+            
+                Scores close to 1 indicate highly subjective sentiments, where passengers' opinions 
+                are strongly influenced by their individual experiences and emotional reactions, 
+                such as "I had the most wonderful flight experience with this airline; the crew 
+                was so attentive and friendly!"
+            
+                On the other hand, scores close to -1 suggest highly objective sentiments, where 
+                opinions are based primarily on factual aspects of the airline's service without
+                much personal bias, as in "The flight departed on time and arrived at the
+                scheduled destination without any issues."
+            
+                Scores close to 0 represent a balance between subjective and objective elements,
+                indicating that opinions about the airline are moderately influenced by personal 
+                experiences but also take into account factual aspects, like "My flight was delayed, but 
+                the airline provided clear communication and assistance, which I appreciated."
+
+                Recognizing sentiment subjectivity is essential for accurately gauging passengers'
+                attitudes toward the airline and understanding the factors driving their opinions.
+                """
+            )
+        st.altair_chart(avg_subjectivity + subjectivity_values, use_container_width=True)
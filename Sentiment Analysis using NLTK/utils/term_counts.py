@@ -0,0 +1,168 @@
+from functools import partial
+from scipy.sparse import csr_matrix, vstack
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+# Results key and n-gram order of every word based count
+NGRAM_ORDERS = {"word_counts": 1, "bigram_counts": 2, "trigram_counts": 3}
+
+
+def get_ngrams(words: List[str], n: int) -> List[str]:
+    """Gets the n-grams of a tweet's words, joined by spaces.
+
+    Args:
+        words (List[str]): The words of the tweet, in order.
+        n (int): The n-gram order.
+
+    Returns:
+        List[str]: The n-grams of the tweet.
+    """
+    return [" ".join(words[i : i + n]) for i in range(len(words) - n + 1)]
+
+
+def get_terms(terms: List[str]) -> List[str]:
+    """Returns the given terms as they are, for already extracted terms.
+
+    Args:
+        terms (List[str]): The terms of the tweet.
+
+    Returns:
+        List[str]: The same terms.
+    """
+    return terms
+
+
+def new_term_matrices() -> dict:
+    """Creates empty document-term matrices, one per n-gram order plus one
+    for the noun phrases. Rows are added batch by batch with add_term_rows.
+
+    Returns:
+        dict: The document-term matrices by results key.
+    """
+    return {
+        key: {
+            "vocabulary": {},
+            "batches": [],
+            "counts": np.zeros(0, dtype=np.int64),
+        }
+        for key in [*NGRAM_ORDERS, "nounphrase_counts"]
+    }
+
+
+def build_batch_matrix(
+    documents: List[List[str]], analyzer, vocabulary: Dict[str, int]
+) -> csr_matrix:
+    """Builds the sparse document-term matrix of a batch of documents. Terms
+    that are not in the vocabulary yet are added to it, so the columns of
+    the batches of a document-term matrix stay aligned.
+
+    Args:
+        documents (List[List[str]]): The documents, one per tweet.
+        analyzer (Callable): Gets the terms of a single document.
+        vocabulary (Dict[str, int]): The column of every term.
+
+    Returns:
+        csr_matrix: The document-term matrix, with one row per document.
+    """
+    indptr = [0]
+    indices = []
+    for document in documents:
+        indices.extend(
+            vocabulary.setdefault(term, len(vocabulary)) for term in analyzer(document)
+        )
+        indptr.append(len(indices))
+    matrix = csr_matrix(
+        (np.ones(len(indices), dtype=np.int64), indices, indptr),
+        shape=(len(documents), len(vocabulary)),
+    )
+    matrix.sum_duplicates()
+    return matrix
+
+
+def add_term_rows(
+    term_matrices: dict, words: List[List[str]], noun_phrases: List[List[str]]
+) -> None:
+    """Adds a batch of tweets to the document-term matrices. Only the new
+    tweets are processed, and the total term counts are updated with theirs.
+
+    Args:
+        term_matrices (dict): The document-term matrices by results key.
+        words (List[List[str]]): The words of every tweet of the batch.
+        noun_phrases (List[List[str]]): The noun phrases of every tweet of the batch.
+    """
+    for key, term_matrix in term_matrices.items():
+        if key == "nounphrase_counts":
+            batch = build_batch_matrix(
+                noun_phrases, get_terms, term_matrix["vocabulary"]
+            )
+        else:
+            analyzer = partial(get_ngrams, n=NGRAM_ORDERS[key])
+            batch = build_batch_matrix(words, analyzer, term_matrix["vocabulary"])
+
+        counts = np.zeros(batch.shape[1], dtype=np.int64)
+        counts[: len(term_matrix["counts"])] = term_matrix["counts"]
+        term_matrix["counts"] = counts + np.asarray(batch.sum(axis=0)).ravel()
+        term_matrix["batches"].append(batch)
+
+
+def get_term_matrix(term_matrix: dict) -> csr_matrix:
+    """Gets the whole document-term matrix, stacking its batches only once.
+
+    Args:
+        term_matrix (dict): A document-term matrix, as built by add_term_rows.
+
+    Returns:
+        csr_matrix: The document-term matrix, with one row per tweet.
+    """
+    num_terms = len(term_matrix["vocabulary"])
+    batches = term_matrix["batches"]
+    if len(batches) != 1 or batches[0].shape[1] != num_terms:
+        # Older batches have no columns for the terms found after them
+        matrix = vstack(
+            [
+                csr_matrix(
+                    (batch.data, batch.indices, batch.indptr),
+                    shape=(batch.shape[0], num_terms),
+                )
+                for batch in batches
+            ]
+            or [csr_matrix((0, num_terms), dtype=np.int64)],
+            format="csr",
+        )
+        term_matrix["batches"] = [matrix]
+    return term_matrix["batches"][0]
+
+
+def get_term_counts(
+    term_matrices: dict, rows: Union[np.ndarray, None] = None
+) -> dict:
+    """Gets the term counts from the column sums of the document-term matrices.
+
+    Args:
+        term_matrices (dict): The document-term matrices by results key.
+        rows (Union[np.ndarray, None]): Boolean mask of the tweets to be
+         counted. All the tweets are counted when not given.
+
+    Returns:
+        dict: The term, count and number of words data frames by results key.
+    """
+    term_counts = {}
+    for key, term_matrix in term_matrices.items():
+        if rows is None:
+            counts = term_matrix["counts"]
+        else:
+            counts = np.asarray(get_term_matrix(term_matrix)[rows].sum(axis=0)).ravel()
+        found = counts > 0
+        terms = pd.Series(
+            np.array(list(term_matrix["vocabulary"]), dtype=object)[found], dtype=object
+        )
+        term_counts[key] = pd.DataFrame(
+            {
+                "term": terms,
+                "count": counts[found],
+                "num_words": terms.str.count(" ") + 1,
+            }
+        )
+    return term_counts
@@ -0,0 +1,40 @@
+from typing import List
+from utils.nltk_manager import DOWNLOAD_FOLDER
+
+import nltk
+import textblob
+
+
+def init_analysis_worker() -> None:
+    """Makes the downloaded ntlk data available to an analysis worker process."""
+    if DOWNLOAD_FOLDER not in nltk.data.path:
+        nltk.data.path.append(DOWNLOAD_FOLDER)
+
+
+def analyze_clean_texts(clean_texts: List[str]) -> List[dict]:
+    """Runs TextBlob over a chunk of already cleaned tweet texts.
+
+    Args:
+        clean_texts (List[str]): The cleaned, lowercased tweet texts.
+
+    Returns:
+        List[dict]: The cleaned text, polarity, subjectivity, words and
+    noun phrases of every text, in the given order.
+    """
+    analyses = []
+
+    for clean_text in clean_texts:
+        blob = textblob.TextBlob(clean_text)
+        sentiment = blob.sentiment
+
+        analyses.append(
+            {
+                "clean_text": clean_text,
+                "polarity": sentiment.polarity,
+                "subjectivity": sentiment.subjectivity,
+                "words": list(blob.words),
+                "noun_phrases": list(blob.noun_phrases),
+            }
+        )
+
+    return analyses
@@ -1,19 +1,51 @@
-from collections import defaultdict, namedtuple
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from nltk.corpus import stopwords
+from typing import Dict, Iterator, List, Optional, Tuple
+from utils.analysis_cache import load_tweet_analyses, store_tweet_analyses
 from utils.data_access import execute_query_with_params
-from utils.helpers import rel_to_abs_date, add_counts, get_counts
-from utils.nltk_manager import download_stopwords
-
+from utils.helpers import rel_to_abs_date
+from utils.nltk_manager import download_stopwords, download_textblob_corpora
+from utils.term_counts import add_term_rows, get_term_counts, new_term_matrices
+from utils.text_analysis import analyze_clean_texts, init_analysis_worker
+
+import logging
+import multiprocessing
+import numpy as np
 import pandas as pd
 import re
 import streamlit as st
-import textblob
+import time
+
+logger = logging.getLogger(__name__)
 
 if "tweets" not in st.session_state:
     st.session_state.tweets = []
     st.session_state.curr_tweet_page = 0
     st.session_state.curr_raw_tweet_page = 0
 
+# Number of tweets analysed by each process pool task
+ANALYSIS_CHUNK_SIZE = 500
+
+# Minimum time between two updates of the statistics while the tweets are analysed
+STATISTICS_UPDATE_SECONDS = 1.0
+
+SentimentListItem = namedtuple(
+    "SentimentListItem", ("date", "polarity", "subjectivity")
+)
+
+# Only the columns used by the app are fetched, instead of SELECT *
+TWEET_COLUMNS = """
+        _UNIT_ID,
+        TEXT,
+        NAME,
+        TWEET_CREATED,
+        RETWEET_COUNT,
+        FAVES,
+        REPLIES,
+        IS_REPLY,
+        IS_RETWEET
+"""
 
 TWEET_CRAP_RE = re.compile(r"\bRT\b", re.IGNORECASE)
 URL_RE = re.compile(r"(^|\W)https?://[\w./&%]+\b", re.IGNORECASE)
@@ -60,20 +92,18 @@ HASH_TAG_RE = re.compile(r"(^|\W)#\w+\b", re.IGNORECASE)
 PREFIX_CHAR_RE = re.compile(r"(^|\W)[#@]", re.IGNORECASE)
 
 
-def clean_tweet_text(tweet_text: str) -> str:
-    """Cleans tweet text.
-
-    Args:
-        tweet_text (str): The tweet text to be cleaned.
+@st.cache_resource(show_spinner=False)
+def get_tweet_cleaning_regexes() -> List[re.Pattern]:
+    """Compiles the tweet cleaning regexes, only once per process.
 
     Returns:
-        str: The cleaned tweet text.
+        List[re.Pattern]: The regexes to be removed from the tweet text, in order.
     """
     download_stopwords()
     stop_words_re = re.compile(
         r"\b(?:" + "|".join(stopwords.words("english")) + r")\b", re.IGNORECASE
     )
-    regexes = [
+    return [
         # AT_MENTION_RE,
         # HASH_TAG_RE,
         EMOJI_RE,
@@ -86,9 +116,19 @@ def clean_tweet_text(tweet_text: str) -> str:
         URL_RE,
     ]
 
-    for regex in regexes:
-        tweet_text = regex.sub("", tweet_text)
-    return tweet_text
+
+def clean_tweet_texts(tweet_texts: pd.Series) -> pd.Series:
+    """Cleans a whole column of tweet texts.
+
+    Args:
+        tweet_texts (pd.Series): The tweet texts to be cleaned.
+
+    Returns:
+        pd.Series: The cleaned tweet texts.
+    """
+    for regex in get_tweet_cleaning_regexes():
+        tweet_texts = tweet_texts.str.replace(regex, "", regex=True)
+    return tweet_texts
 
 
 def display_tweet(tweet: pd.core.series.Series) -> None:
@@ -97,27 +137,34 @@ def display_tweet(tweet: pd.core.series.Series) -> None:
     Args:
         tweet (pd.core.series.Series): The given tweet.
     """
-    parsed_tweet = {
-        "author": tweet["NAME"],
-        "created_at": tweet["TWEET_CREATED"],
-        "text": tweet["TEXT"],
-    }
-
-    for key, value in parsed_tweet.items():
-        dict_col_left, dict_col_rifht = st.columns([1, 4])
-        dict_col_left.write(f"**{key}:**")
-        dict_col_rifht.write(value)
+    st.markdown(
+        f"**author:** {tweet['NAME']}  \n"
+        f"**created_at:** {tweet['TWEET_CREATED']}  \n"
+        f"**text:** {tweet['TEXT']}"
+    )
 
 
-def search_term_in_twitter_text(search_parameters: dict) -> pd.DataFrame:
-    """Searchs a giving termn in the twitter texts.
+def get_tweets_query(
+    columns: str,
+    search_parameters: dict,
+    after_key: Optional[Tuple[str, str]] = None,
+    page_size: Optional[int] = None,
+) -> Tuple[str, List]:
+    """Builds the query that selects the tweets matching the search filters.
 
     Args:
-        search_parameters (str): The neccesary search parameters
+        columns (str): The columns to be selected.
+        search_parameters (dict): The neccesary search parameters
          to be used to find the right tweets.
+        after_key (Optional[Tuple[str, str]]): The creation date and id of the
+         last tweet of the previous page. Only tweets after it are selected.
+        page_size (Optional[int]): When given, a single page of tweets is
+         selected, instead of up to the search limit. Tweets are always ordered
+         by creation date and id, so the pages walk the same tweets the search
+         limit selects.
 
     Returns:
-        pd.DataFrame: The found tweets as a pandas dataframe.
+        Tuple[str, List]: The query and its parameters.
     """
     days_ago = search_parameters["days_ago"]
     tweet_created_filter = "" if days_ago is None else "AND tweet_created >= ?"
@@ -127,10 +174,14 @@ def search_term_in_twitter_text(search_parameters: dict) -> pd.DataFrame:
     is_retweet_filter = (
         "AND IS_RETWEET = FALSE" if st.session_state.chck_excl_rtweets else ""
     )
-
+    after_key_filter = (
+        ""
+        if after_key is None
+        else "AND (tweet_created > ? OR (tweet_created = ? AND _unit_id > ?))"
+    )
     airlines_tweets_query = f"""
     SELECT
-        *
+        {columns}
     FROM
         airlines_sentiment_db.airlines_sentiment_s.airline_sentiment_table
     where
@@ -141,6 +192,9 @@ def search_term_in_twitter_text(search_parameters: dict) -> pd.DataFrame:
         AND replies >= ?
         {is_reply_filter}
         {is_retweet_filter}
+        {after_key_filter}
+    order by
+        tweet_created, _unit_id
     limit
         ?
     """
@@ -151,26 +205,104 @@ def search_term_in_twitter_text(search_parameters: dict) -> pd.DataFrame:
     airlines_tweets_params.append(st.session_state.num_i_min_rtweets)
     airlines_tweets_params.append(st.session_state.num_i_min_hearts)
     airlines_tweets_params.append(st.session_state.num_i_min_replies)
-    airlines_tweets_params.append(st.session_state.num_i_limit)
+    if after_key is not None:
+        tweet_created, tweet_id = after_key
+        airlines_tweets_params.extend([tweet_created, tweet_created, tweet_id])
+    airlines_tweets_params.append(
+        st.session_state.num_i_limit if page_size is None else page_size
+    )
+
+    return airlines_tweets_query, airlines_tweets_params
+
+
+def search_term_in_twitter_text(search_parameters: dict) -> pd.DataFrame:
+    """Searchs a giving termn in the twitter texts.
+
+    Args:
+        search_parameters (str): The neccesary search parameters
+         to be used to find the right tweets.
+
+    Returns:
+        pd.DataFrame: The found tweets as a pandas dataframe.
+    """
+    airlines_tweets_query, airlines_tweets_params = get_tweets_query(
+        TWEET_COLUMNS, search_parameters
+    )
 
     return execute_query_with_params(airlines_tweets_query, airlines_tweets_params)
 
 
+@st.cache_resource(show_spinner=False)
+def get_prefetch_pool() -> ThreadPoolExecutor:
+    """Gets the thread pool used to prefetch the next page of tweets.
+
+    Returns:
+        ThreadPoolExecutor: A small thread pool shared by the app sessions.
+    """
+    return ThreadPoolExecutor(max_workers=2)
+
+
+def log_prefetch_error(future: Future) -> None:
+    """Logs the error of a failed prefetch. The page is then fetched again
+    when it is requested.
+
+    Args:
+        future (Future): The finished prefetch.
+    """
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(
+            "Could not prefetch the next page of tweets", exc_info=future.exception()
+        )
+
+
 def get_tweets_paginated(
-    tweets_df: pd.DataFrame, session_state_current_page_key: str, page_size: int
-):
-    """Gets given data frame paginated by provided page size.
+    search_parameters: dict, session_state_current_page_key: str, page_size: int
+) -> pd.DataFrame:
+    """Gets the matching tweets one page at a time from Snowflake, using keyset
+    pagination on the creation date and id. The next page is prefetched in the
+    background, so it is already cached when requested.
 
     Args:
-        tweets_df (pd.DataFrame): The tweet data frame.
+        search_parameters (dict): The neccesary search parameters
+         to be used to find the right tweets.
         session_state_current_page_key (str): The session state key to identify current page.
         page_size (int): The page size to be paginated.
 
     Returns:
-        _type_: _description_
+        pd.DataFrame: The tweets of the current page.
     """
+    page_keys_key = f"{session_state_current_page_key}_page_keys"
+    search_key = f"{session_state_current_page_key}_search"
+
+    # Start over from the first page whenever the search changes
+    search = get_tweets_query(TWEET_COLUMNS, search_parameters)
+    search = (search[0], tuple(search[1]))
+    if st.session_state.get(search_key) != search:
+        st.session_state[search_key] = search
+        st.session_state[page_keys_key] = [None]
+        setattr(st.session_state, session_state_current_page_key, 0)
+
+    # The key of every page is the creation date and id of the last tweet of the previous one
+    page_keys = st.session_state[page_keys_key]
     curr_page = getattr(st.session_state, session_state_current_page_key)
-    p_left_column, p_center_column, p_right_column = st.columns(3)
+    rows_left = st.session_state.num_i_limit - curr_page * page_size
+
+    page = execute_query_with_params(
+        *get_tweets_query(
+            TWEET_COLUMNS, search_parameters, page_keys[curr_page], page_size
+        )
+    ).head(rows_left)
+
+    if len(page) == page_size and rows_left > page_size:
+        last_tweet = page.iloc[-1]
+        next_key = (last_tweet["TWEET_CREATED"].isoformat(), last_tweet["_UNIT_ID"])
+        del page_keys[curr_page + 1 :]
+        page_keys.append(next_key)
+        prefetch = get_prefetch_pool().submit(
+            execute_query_with_params,
+            *get_tweets_query(TWEET_COLUMNS, search_parameters, next_key, page_size),
+        )
+        prefetch.add_done_callback(log_prefetch_error)
 
     def decrement_page():
         curr_page = getattr(st.session_state, session_state_current_page_key)
@@ -179,95 +311,174 @@ def get_tweets_paginated(
 
     def increment_page():
         curr_page = getattr(st.session_state, session_state_current_page_key)
-        if curr_page + 1 < len(tweets_df) // page_size:
+        if curr_page + 1 < len(st.session_state[page_keys_key]):
             setattr(st.session_state, session_state_current_page_key, curr_page + 1)
 
-    def set_page():
-        setattr(
-            st.session_state,
-            session_state_current_page_key,
-            getattr(st.session_state, f"{session_state_current_page_key}_selected_page")
-            - 1,
-        )
-
-    p_left_column.write(" ")
-    p_left_column.write(" ")
+    p_left_column, p_center_column, p_right_column = st.columns(3)
     p_left_column.button(
         "Previous page",
         on_click=decrement_page,
+        disabled=curr_page == 0,
         key=f"{session_state_current_page_key}_prev_b",
     )
-    p_center_column.write(" ")
-    p_center_column.write(" ")
     p_center_column.button(
         "Next page",
         on_click=increment_page,
+        disabled=curr_page + 1 >= len(page_keys),
         key=f"{session_state_current_page_key}_next_b",
     )
+    p_right_column.write(f"Page {curr_page + 1}")
+
+    return page
+
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_pool() -> ProcessPoolExecutor:
+    """Gets the process pool used to run the TextBlob analysis, one per app process.
+    The workers are spawned rather than forked, as forking the multi-threaded
+    app server can deadlock the workers on locks held by its other threads.
 
-    p_right_column.selectbox(
-        "Select a page",
-        range(1, len(tweets_df) // page_size + 1),
-        curr_page,
-        on_change=set_page,
-        key=f"{session_state_current_page_key}_selected_page",
+    Returns:
+        ProcessPoolExecutor: A process pool with one worker per core.
+    """
+    return ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_analysis_worker,
     )
 
-    curr_page = getattr(st.session_state, session_state_current_page_key)
 
-    page_start = curr_page * page_size
-    page_end = page_start + page_size
+def analyze_new_tweets(tweets_df: pd.DataFrame) -> Iterator[Dict[str, dict]]:
+    """Analyses the given tweets with TextBlob. The tweets are split in chunks
+    that are analysed in parallel by a process pool.
 
-    return tweets_df[page_start:page_end]
+    Args:
+        tweets_df (pd.DataFrame): Tweets as a pandas data frame.
 
+    Yields:
+        Dict[str, dict]: The analysis of every tweet of a chunk by tweet id,
+    as soon as the chunk is analysed.
+    """
+    download_textblob_corpora()
+    tweet_ids = tweets_df["_UNIT_ID"].astype(str).tolist()
+    clean_texts = clean_tweet_texts(tweets_df["TEXT"]).str.lower().tolist()
+    starts = range(0, len(clean_texts), ANALYSIS_CHUNK_SIZE)
+    chunks = [clean_texts[start : start + ANALYSIS_CHUNK_SIZE] for start in starts]
 
-def get_text_blob_statistics(tweets_df: pd.DataFrame) -> dict:
-    """Process tweets to get sentiment, word count, bigram count,
-    trigram count and noun phrase count.
+    if len(chunks) > 1:
+        partial_results = get_analysis_pool().map(analyze_clean_texts, chunks)
+    else:
+        partial_results = map(analyze_clean_texts, chunks)
+
+    # Results come back in chunk order, so they stay aligned with the tweet ids
+    for start, analyses in zip(starts, partial_results):
+        yield dict(zip(tweet_ids[start : start + ANALYSIS_CHUNK_SIZE], analyses))
+
+
+def add_text_blob_statistics(
+    statistics: dict, tweets_df: pd.DataFrame, analyses: Dict[str, dict]
+) -> None:
+    """Adds the sentiment and terms of a batch of analysed tweets to the
+    statistics, without going over the tweets added before.
 
     Args:
-        tweets (pd.DataFrame): Tweets as a pandas data frame.
+        statistics (dict): The sentiment list and document-term matrices
+         of the tweets added so far.
+        tweets_df (pd.DataFrame): The tweets of the batch.
+        analyses (Dict[str, dict]): The analysis of the tweets by tweet id.
+    """
+    tweet_analyses = [
+        analyses[tweet_id] for tweet_id in tweets_df["_UNIT_ID"].astype(str)
+    ]
+    statistics["sentiment_list"].extend(
+        SentimentListItem(tweet_created, analysis["polarity"], analysis["subjectivity"])
+        for tweet_created, analysis in zip(
+            tweets_df["TWEET_CREATED"], tweet_analyses
+        )
+    )
+    add_term_rows(
+        statistics["term_matrices"],
+        [analysis["words"] for analysis in tweet_analyses],
+        [analysis["noun_phrases"] for analysis in tweet_analyses],
+    )
+
+
+def get_text_blob_statistics(statistics: dict) -> dict:
+    """Gets sentiment, word count, bigram count, trigram count and noun phrase
+    count of the tweets added to the statistics so far.
+
+    Args:
+        statistics (dict): The sentiment list and document-term matrices
+         of the tweets, as built by add_text_blob_statistics.
 
     Returns:
         dict: A dictionay with sentiment value, word count, bigram count,
-    trigram count and noun phrase count.
+    trigram count, noun phrase count and the document-term matrices the
+    counts come from, so they can be recounted for a subset of the tweets.
     """
-    word_counts = defaultdict(int)
-    bigram_counts = defaultdict(int)
-    trigram_counts = defaultdict(int)
-    nounphrase_counts = defaultdict(int)
-    sentiment_list = []
-
-    SentimentListItem = namedtuple(
-        "SentimentListItem", ("date", "polarity", "subjectivity")
-    )
+    return {
+        **get_term_counts(statistics["term_matrices"]),
+        "term_matrices": statistics["term_matrices"],
+        "sentiment_list": statistics["sentiment_list"],
+    }
 
-    for _, tweet in tweets_df.iterrows():
-        clean_text = clean_tweet_text(tweet["TEXT"]).lower()
-        blob = textblob.TextBlob(clean_text)
 
-        add_counts(word_counts, blob.word_counts)
-        add_counts(bigram_counts, get_counts(blob.ngrams(2), key_sep=" "))
-        add_counts(trigram_counts, get_counts(blob.ngrams(3), key_sep=" "))
-        add_counts(nounphrase_counts, get_counts(blob.noun_phrases, key_sep=""))
+def iter_text_blob_statistics(tweets_df: pd.DataFrame) -> Iterator[Tuple[float, dict]]:
+    """Process tweets to get sentiment, word count, bigram count,
+    trigram count and noun phrase count. Only tweets that are not in
+    the analysis cache yet go through TextBlob, and the statistics are
+    updated with every analysed chunk, at most every
+    STATISTICS_UPDATE_SECONDS. The statistics of the last search are
+    kept in the session, so reruns of the same search, like the ones of
+    the term dates slider, don't compute them again.
 
-        sentiment_list.append(
-            SentimentListItem(
-                tweet["TWEET_CREATED"],
-                blob.sentiment.polarity,
-                blob.sentiment.subjectivity,
-            )
+    Args:
+        tweets (pd.DataFrame): Tweets as a pandas data frame.
+
+    Yields:
+        Tuple[float, dict]: The share of tweets analysed so far and
+    their statistics, as returned by get_text_blob_statistics.
+    """
+    tweet_ids = tweets_df["_UNIT_ID"].astype(str)
+    statistics_key = tuple(tweet_ids)
+    cached_statistics = st.session_state.get("text_blob_statistics")
+    if cached_statistics is not None and cached_statistics[0] == statistics_key:
+        yield 1.0, cached_statistics[1]
+        return
+
+    unique_tweet_ids = tweet_ids.unique().tolist()
+    analyses = load_tweet_analyses(unique_tweet_ids)
+
+    statistics = {"term_matrices": new_term_matrices(), "sentiment_list": []}
+    add_text_blob_statistics(
+        statistics, tweets_df[tweet_ids.isin(analyses.keys())], analyses
+    )
+
+    new_tweets = tweets_df[~tweet_ids.isin(analyses.keys())].drop_duplicates(
+        subset=["_UNIT_ID"]
+    )
+    if analyses and not new_tweets.empty:
+        yield len(analyses) / len(unique_tweet_ids), get_text_blob_statistics(
+            statistics
         )
 
-    def to_df(the_dict):
-        items = the_dict.items()
-        items = ((term, count, len(term.split(" "))) for (term, count) in items)
-        return pd.DataFrame(items, columns=("term", "count", "num_words"))
+    if not new_tweets.empty:
+        # Rows of every tweet id, to get the tweets of each analysed chunk without searching them
+        tweet_rows = tweet_ids.groupby(tweet_ids, sort=False).indices
+        last_update = time.monotonic()
+        for new_analyses in analyze_new_tweets(new_tweets):
+            store_tweet_analyses(new_analyses)
+            analyses.update(new_analyses)
+            rows = np.concatenate([tweet_rows[tweet_id] for tweet_id in new_analyses])
+            add_text_blob_statistics(
+                statistics, tweets_df.iloc[np.sort(rows)], new_analyses
+            )
 
-    return {
-        "word_counts": to_df(word_counts),
-        "bigram_counts": to_df(bigram_counts),
-        "trigram_counts": to_df(trigram_counts),
-        "nounphrase_counts": to_df(nounphrase_counts),
-        "sentiment_list": sentiment_list,
-    }
+            if time.monotonic() - last_update >= STATISTICS_UPDATE_SECONDS:
+                last_update = time.monotonic()
+                yield len(analyses) / len(unique_tweet_ids), (
+                    get_text_blob_statistics(statistics)
+                )
+
+    results = get_text_blob_statistics(statistics)
+    st.session_state.text_blob_statistics = (statistics_key, results)
+    yield 1.0, results
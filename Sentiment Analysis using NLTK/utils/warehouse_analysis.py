@@ -0,0 +1,148 @@
+from nltk.corpus import stopwords
+from utils.data_access import execute_query_with_params
+from utils.nltk_manager import download_stopwords
+from utils.tweet_manipulation import get_tweets_query
+
+import json
+import pandas as pd
+
+# Maximum number of terms returned for every n-gram order
+TOP_TERMS_LIMIT = 500
+
+# Tweet specific noise that is dropped along with the english stopwords
+EXTRA_STOPWORDS = ["rt", "w", "bc", "wo"]
+
+
+def get_warehouse_sentiment(search_parameters: dict) -> pd.DataFrame:
+    """Scores the polarity of the matching tweets with Snowflake Cortex and
+    averages it by hour, so only the aggregates leave the warehouse.
+
+    Args:
+        search_parameters (dict): The neccesary search parameters
+         to be used to find the right tweets.
+
+    Returns:
+        pd.DataFrame: The hourly mean polarity and number of tweets.
+    """
+    tweets_query, params = get_tweets_query("TEXT, TWEET_CREATED", search_parameters)
+
+    sentiment_query = f"""
+    SELECT
+        DATE_TRUNC('HOUR', TWEET_CREATED) AS DATE,
+        AVG(SNOWFLAKE.CORTEX.SENTIMENT(TEXT)) AS POLARITY,
+        COUNT(*) AS NUM_TWEETS
+    FROM
+        ({tweets_query})
+    GROUP BY
+        1
+    ORDER BY
+        1
+    """
+
+    return execute_query_with_params(sentiment_query, params)
+
+
+def get_warehouse_term_counts(search_parameters: dict) -> pd.DataFrame:
+    """Counts the words, bigrams and trigrams of the matching tweets with
+    SPLIT_TO_TABLE in the warehouse, returning only the top terms.
+
+    Args:
+        search_parameters (dict): The neccesary search parameters
+         to be used to find the right tweets.
+
+    Returns:
+        pd.DataFrame: The top terms of every n-gram order with their counts.
+    """
+    tweets_query, params = get_tweets_query("TEXT", search_parameters)
+
+    download_stopwords()
+    stop_words = stopwords.words("english") + EXTRA_STOPWORDS
+
+    # URLs, numbers, emojis and punctuation are removed before splitting the words
+    terms_query = f"""
+    WITH TOKENS AS (
+        SELECT
+            T.SEQ,
+            T.INDEX,
+            T.VALUE AS WORD
+        FROM
+            ({tweets_query}) AS TWEETS,
+            LATERAL SPLIT_TO_TABLE(
+                REGEXP_REPLACE(
+                    LOWER(REGEXP_REPLACE(TWEETS.TEXT, 'https?://\\\\S+', ' ')),
+                    '[^a-z\\']+',
+                    ' '
+                ),
+                ' '
+            ) AS T
+        WHERE
+            T.VALUE <> ''
+            AND NOT ARRAY_CONTAINS(T.VALUE::VARIANT, PARSE_JSON(?))
+    ),
+    NGRAMS AS (
+        SELECT
+            WORD AS W1,
+            LEAD(WORD, 1) OVER (PARTITION BY SEQ ORDER BY INDEX) AS W2,
+            LEAD(WORD, 2) OVER (PARTITION BY SEQ ORDER BY INDEX) AS W3
+        FROM
+            TOKENS
+    ),
+    TERMS AS (
+        SELECT W1 AS TERM, 1 AS NUM_WORDS FROM NGRAMS
+        UNION ALL
+        SELECT W1 || ' ' || W2, 2 FROM NGRAMS WHERE W2 IS NOT NULL
+        UNION ALL
+        SELECT W1 || ' ' || W2 || ' ' || W3, 3 FROM NGRAMS WHERE W3 IS NOT NULL
+    )
+    SELECT
+        TERM,
+        COUNT(*) AS COUNT,
+        NUM_WORDS
+    FROM
+        TERMS
+    GROUP BY
+        TERM,
+        NUM_WORDS
+    QUALIFY
+        ROW_NUMBER() OVER (PARTITION BY NUM_WORDS ORDER BY COUNT(*) DESC) <= ?
+    """
+
+    return execute_query_with_params(
+        terms_query, params + [json.dumps(stop_words), TOP_TERMS_LIMIT]
+    )
+
+
+def get_warehouse_statistics(search_parameters: dict) -> dict:
+    """Process the matching tweets in Snowflake to get sentiment, word count,
+    bigram count and trigram count. Cortex does not score subjectivity and
+    noun phrases are not extracted, so those are left empty.
+
+    Args:
+        search_parameters (dict): The neccesary search parameters
+         to be used to find the right tweets.
+
+    Returns:
+        dict: A dictionay with sentiment value, word count, bigram count,
+    trigram count, noun phrase count and the number of analysed tweets.
+    """
+    sentiment_df = get_warehouse_sentiment(search_parameters)
+    terms_df = get_warehouse_term_counts(search_parameters)
+    terms_df.columns = terms_df.columns.str.lower()
+
+    sentiment_list = pd.DataFrame(
+        {
+            "date": sentiment_df["DATE"],
+            "polarity": sentiment_df["POLARITY"].astype(float),
+            "subjectivity": float("nan"),
+            "num_tweets": sentiment_df["NUM_TWEETS"].astype(int),
+        }
+    )
+
+    return {
+        "word_counts": terms_df[terms_df["num_words"] == 1],
+        "bigram_counts": terms_df[terms_df["num_words"] == 2],
+        "trigram_counts": terms_df[terms_df["num_words"] == 3],
+        "nounphrase_counts": pd.DataFrame(columns=("term", "count", "num_words")),
+        "sentiment_list": sentiment_list,
+        "num_tweets": int(sentiment_df["NUM_TWEETS"].sum()),
+    }
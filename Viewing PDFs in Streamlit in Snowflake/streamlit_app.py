@@ -1,8 +1,19 @@
 # Import python packages
 import streamlit as st
 from snowflake.snowpark.context import get_active_session
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+import hashlib
+import os
 import pypdfium2 as pdfium
 import pandas as pd
+import shutil
+import tempfile
+import weakref
+
+# Downloaded stage files are kept here, up to the given size
+FILE_CACHE_FOLDER = '/tmp/stage_file_cache'
+FILE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
 
 st.set_page_config(
     layout="wide"
@@ -13,6 +24,130 @@ st.title('Viewing PDFs in Streamlit in Snowflake')
 # Get the current credentials
 session = get_active_session()
 
+# Sessions share the file cache, so it is updated under this lock
+@st.cache_resource
+def get_file_cache_lock():
+    return Lock()
+
+# One lock per cached file, so sessions missing the same file download it only once.
+# A lock is dropped once no session holds it.
+@st.cache_resource
+def get_download_locks():
+    return weakref.WeakValueDictionary()
+
+def get_download_lock(key):
+    with get_file_cache_lock():
+        return get_download_locks().setdefault(key, Lock())
+
+# Evict the least recently used files until the cache fits its maximum size
+def evict_cached_files(keep_path):
+    files = []
+    for entry in os.scandir(FILE_CACHE_FOLDER):
+        if entry.is_file() and entry.path != keep_path:
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    cache_size = sum(size for _, size, _ in files) + os.path.getsize(keep_path)
+    for _, size, path in sorted(files):
+        if cache_size <= FILE_CACHE_MAX_BYTES:
+            break
+        # Sessions that already opened the file keep reading it after it is removed
+        os.remove(path)
+        cache_size -= size
+
+# Get the local path of a stage file, downloading it only if this version of the file isn't cached yet.
+# Files are addressed by their stage path and the MD5 (or ETAG) of the directory table,
+# so a changed file gets a new path, and the modification time of the cached files tracks their last use.
+def get_cached_file(stage_file, version):
+    key = hashlib.sha256(f"{stage_file}\n{version}".encode()).hexdigest()
+    cached_path = os.path.join(FILE_CACHE_FOLDER, f"{key}{os.path.splitext(stage_file)[1]}")
+    os.makedirs(FILE_CACHE_FOLDER, exist_ok=True)
+
+    # Sessions waiting on the download of the same file find it cached once they get the lock
+    with get_download_lock(key):
+        with get_file_cache_lock():
+            if os.path.exists(cached_path):
+                os.utime(cached_path)
+                return cached_path
+
+        # Download to a folder of its own, then move the file in place, so no one reads a partial download
+        download_folder = tempfile.mkdtemp(dir=FILE_CACHE_FOLDER)
+        try:
+            session.file.get(stage_file, download_folder)
+            downloaded_file = os.path.join(download_folder, os.listdir(download_folder)[0])
+            with get_file_cache_lock():
+                os.replace(downloaded_file, cached_path)
+                evict_cached_files(cached_path)
+        finally:
+            shutil.rmtree(download_folder, ignore_errors=True)
+    return cached_path
+
+# pdfium is not thread safe, so every thread of every session renders through this lock
+@st.cache_resource
+def get_pdfium_lock():
+    return Lock()
+
+# Pages are rendered on these threads, ahead of being displayed
+@st.cache_resource
+def get_render_pool():
+    return ThreadPoolExecutor(max_workers=2)
+
+# The page and its bitmap are closed under the lock, instead of by their finalizers on any thread,
+# so the pixels are copied first, as the PIL image of the bitmap shares its buffer
+def render_page(pdf, page_num, zoom_scale, lock):
+    with lock:
+        page = pdf[page_num]
+        try:
+            bitmap = page.render(
+                scale = zoom_scale, 
+                rotation = 0, # no additional rotation
+                # ... further rendering options https://pypdfium2.readthedocs.io/en/stable/python_api.html#pypdfium2._helpers.page.PdfPage.render
+            )
+            try:
+                return bitmap.to_pil().copy()
+            finally:
+                bitmap.close()
+        finally:
+            page.close()
+
+# Get the rendered pages of the session, as futures by page number.
+# They are dropped, and the previous PDF closed, when another PDF or zoom is selected.
+# The PDF is opened, closed and its page count read under the pdfium lock, as other pages may be rendering.
+def get_page_renders(pdf_path, zoom_scale):
+    renders = st.session_state.get('page_renders')
+    if renders is None or renders['key'] != (pdf_path, zoom_scale):
+        if renders is not None:
+            # Pages that already started rendering can't be cancelled, so let them finish before closing their PDF
+            pending_pages = list(renders['pages'].values())
+            release_pages(renders['pages'], range(0))
+            wait(pending_pages)
+        with get_pdfium_lock():
+            if renders is not None:
+                renders['pdf'].close()
+            pdf = pdfium.PdfDocument(pdf_path)
+            num_pages = len(pdf)
+        renders = {
+            'key': (pdf_path, zoom_scale),
+            'pdf': pdf,
+            'num_pages': num_pages,
+            'pages': {},
+        }
+        st.session_state['page_renders'] = renders
+    return renders
+
+# Start rendering the pages that are not rendered nor being rendered yet
+def request_pages(renders, page_nums, zoom_scale):
+    for page_num in page_nums:
+        if page_num not in renders['pages']:
+            renders['pages'][page_num] = get_render_pool().submit(
+                render_page, renders['pdf'], page_num, zoom_scale, get_pdfium_lock()
+            )
+
+# Release the rendered pages outside of the given range
+def release_pages(pages, keep):
+    for page_num in list(pages):
+        if page_num not in keep:
+            pages.pop(page_num).cancel()
+
 def get_stages():
     stages = session.sql("SHOW STAGES").collect()
     # Format as a Pandas DataFrame before returning
@@ -57,10 +192,14 @@ with pdf_selector_cols[0]:
     selected_pdf = st.selectbox('Choose PDF', df['RELATIVE_PATH'])
 
 
-# Get the selected PDF
-session.file.get(f"""@"{db}"."{schema}"."{stage}"/{selected_pdf}""", f"/tmp")
+# Get the selected PDF, from the local cache when it didn't change
+selected_file = df[df['RELATIVE_PATH'] == selected_pdf].iloc[0]
+pdf_path = get_cached_file(
+    f"""@"{db}"."{schema}"."{stage}"/{selected_pdf}""",
+    selected_file['MD5'] if pd.notna(selected_file['MD5']) else selected_file['ETAG'],
+)
 
-with open(f"/tmp/{selected_pdf}", "rb") as pdf_file:
+with open(pdf_path, "rb") as pdf_file:
     st.download_button(
         label='Download PDF', 
         data=pdf_file,
@@ -71,15 +210,30 @@ with pdf_selector_cols[1]:
     zoom_scale = st.selectbox('Zoom', [0.5,0.75,1,2,3,4], 2)
 
 # Display the PDF
-pdf = pdfium.PdfDocument(f"/tmp/{selected_pdf}")
-
-# Iterate through the pages
-for page_num in range(len(pdf)):
-    # Render the page
-    bitmap = pdf[page_num].render(
-        scale = zoom_scale, 
-        rotation = 0, # no additional rotation
-        # ... further rendering options https://pypdfium2.readthedocs.io/en/stable/python_api.html#pypdfium2._helpers.page.PdfPage.render
-    )
-    pil_image = bitmap.to_pil()
-    st.image(pil_image)
+renders = get_page_renders(pdf_path, zoom_scale)
+num_pages = renders['num_pages']
+if num_pages == 0:
+    st.info('This PDF has no pages')
+    st.stop()
+
+# Only the pages in view are rendered, instead of the whole document
+page_selector_cols = st.columns([3,1])
+with page_selector_cols[1]:
+    pages_per_view = st.selectbox('Pages per view', [1,5,10,20], 1)
+
+with page_selector_cols[0]:
+    first_page = st.number_input('From page', 1, num_pages, 1, pages_per_view) - 1
+
+visible_pages = range(first_page, min(first_page + pages_per_view, num_pages))
+previous_pages = range(max(first_page - pages_per_view, 0), first_page)
+next_pages = range(visible_pages.stop, min(visible_pages.stop + pages_per_view, num_pages))
+
+# The neighbouring pages are rendered ahead, so moving to them is instant.
+# Everything further away is released to keep memory bounded.
+release_pages(renders['pages'], range(previous_pages.start, next_pages.stop))
+request_pages(renders, visible_pages, zoom_scale)
+request_pages(renders, next_pages, zoom_scale)
+request_pages(renders, previous_pages, zoom_scale)
+
+for page_num in visible_pages:
+    st.image(renders['pages'][page_num].result(), caption=f"Page {page_num + 1} of {num_pages}")